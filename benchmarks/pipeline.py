@@ -0,0 +1,158 @@
+""" Offline benchmark of the pipeline stages against the local OpenAlex/Namsor stand-in (standin.py).
+
+    For each journal size, runs iterate_search, add_geodata, predict_genders (get_genders_dict) and
+    write_data on a fresh GenderData, and reports per stage: wall time, throughput (works/s),
+    requests and 429s served, client latency percentiles (per request, including retries)
+    and peak Python memory.
+
+    usage: python benchmarks/pipeline.py [--sizes 1000 10000 100000] [--latency SECONDS] [--rate_429 FRACTION]
+                                         [--engine {threads,async}] [--rate_limit N] [--json PATH] ...
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import tracemalloc
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import multiRequests
+from genderClass import GenderData
+from standin import StandIn, add_standin_arguments, standin_options
+
+STAGES = ['iterate_search', 'add_geodata', 'predict_genders', 'write_data']
+
+class LatencyRecorder():
+    """ Wraps multiRequests.send (and send_async) to record the duration of each request.
+    """
+    def __init__(self):
+        self.latencies = []
+        self.lock = threading.Lock()
+        self.send, self.send_async = multiRequests.send, multiRequests.send_async
+
+    def __enter__(self):
+        def send(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return self.send(*args, **kwargs)
+            finally:
+                self.add(time.perf_counter() - start)
+        async def send_async(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await self.send_async(*args, **kwargs)
+            finally:
+                self.add(time.perf_counter() - start)
+        multiRequests.send, multiRequests.send_async = send, send_async
+        return self
+
+    def __exit__(self, *exc):
+        multiRequests.send, multiRequests.send_async = self.send, self.send_async
+
+    def add(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def take(self):
+        """ Returns and clears the latencies recorded so far.
+        """
+        with self.lock:
+            latencies, self.latencies = self.latencies, []
+        return latencies
+
+def analysis_args(engine, shards=1):
+    """ Returns the parsed commandline arguments of a `-g -m` run (see main.parseArguments).
+    """
+    return argparse.Namespace(journal_name='stand-in', batch=None, sample_size=None, verbose=False,
+                              abstracts=False, lazy_abstracts=False, gender=True, maps=True,
+                              map_decades=False, countries=False, stats_only=False, restore_saved=False, update=False, resume=False,
+                              start_year=None, end_year=None, prefetch=2, shards=shards, engine=engine)
+
+def benchmark_config(directory):
+    return {'email' : 'benchmark@example.com', 'namsor_key' : 'benchmark',
+            'journal_data' : {'src' : os.path.join(directory, 'data'), 'dst' : os.path.join(directory, 'data')},
+            'output' : {'csv' : os.path.join(directory, 'data.csv'), 'map' : os.path.join(directory, 'map.png'),
+                        'gender-plot' : os.path.join(directory, 'gender.png')},
+            'gender_cache' : {'path' : os.path.join(directory, 'genders.sqlite')},
+            'geodata_cache' : {'path' : os.path.join(directory, 'geodata.sqlite')}}
+
+def benchmark_size(num_works, args):
+    """ Runs every stage for a journal of num_works works, returns a list of per-stage results.
+    """
+    standin = StandIn(num_works, **standin_options(args))
+    base_url = standin.start()
+    multiRequests.OPENALEX_API = base_url
+    multiRequests.NAMSOR_API = base_url + '/namsor'
+    multiRequests.RATE_LIMITS[standin.host()] = args.rate_limit
+    multiRequests.ENGINE = args.engine
+
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as directory, LatencyRecorder() as recorder:
+            data = GenderData(analysis_args(args.engine, args.shards), benchmark_config(directory))
+            recorder.take() # leave out the source lookup
+            for stage in STAGES:
+                results.append(run_stage(data, stage, num_works, standin, recorder))
+                if stage == 'iterate_search' and len(data.works) != num_works:
+                    raise Exception("Crawled {} works of {} (issue components left out)".format(len(data.works), num_works))
+    finally:
+        standin.stop()
+    return results
+
+def run_stage(data, stage, num_works, standin, recorder):
+    before = standin.snapshot()
+    tracemalloc.reset_peak()
+    start, cpu_start = time.perf_counter(), time.process_time()
+    getattr(data, stage)()
+    wall, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+    peak = tracemalloc.get_traced_memory()[1]
+    after = standin.snapshot()
+
+    latencies = np.array(recorder.take())
+    percentiles = np.percentile(latencies, [50, 90, 99]) if len(latencies) else [np.nan] * 3
+    requests = {endpoint : count - before['counts'].get(endpoint, 0)
+                for endpoint, count in after['counts'].items() if count > before['counts'].get(endpoint, 0)}
+    return {'works' : num_works, 'stage' : stage, 'wall_s' : wall, 'cpu_s' : cpu,
+            'works_per_s' : num_works / wall if wall else np.inf,
+            'requests' : requests, 'throttled' : after['throttled'] - before['throttled'],
+            'bytes' : after['bytes_sent'] - before['bytes_sent'],
+            'latency_p50_ms' : percentiles[0] * 1000, 'latency_p90_ms' : percentiles[1] * 1000,
+            'latency_p99_ms' : percentiles[2] * 1000, 'peak_mb' : peak / 2**20}
+
+def print_results(results):
+    print("{:>8} {:<16} {:>8} {:>8} {:>10} {:>6} {:>5} {:>9} {:>9} {:>9} {:>9}".format(
+          'works', 'stage', 'wall s', 'cpu s', 'works/s', 'reqs', '429s', 'p50 ms', 'p90 ms', 'p99 ms', 'peak MB'))
+    for result in results:
+        print("{works:>8} {stage:<16} {wall_s:>8.2f} {cpu_s:>8.2f} {works_per_s:>10.0f} {reqs:>6} {throttled:>5} "
+              "{latency_p50_ms:>9.1f} {latency_p90_ms:>9.1f} {latency_p99_ms:>9.1f} {peak_mb:>9.1f}"
+              .format(reqs=sum(result['requests'].values()), **result))
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages against a local API stand-in")
+    parser.add_argument("--sizes", type=int, nargs='+', default=[1000, 10000, 100000],
+                        help="journal sizes (works) to benchmark (default 1000 10000 100000)")
+    parser.add_argument("--engine", choices=["threads", "async"], default="threads",
+                        help="request engine (see main.py --engine)")
+    parser.add_argument("--shards", type=int, default=1, help="publication year shards crawled at once (see main.py --shards)")
+    parser.add_argument("--rate_limit", type=float, default=1000,
+                        help="client requests per second to the stand-in (default 1000)")
+    parser.add_argument("--json", dest="json_path", default=None, help="also write the results to this JSON file")
+    add_standin_arguments(parser)
+    return parser.parse_args()
+
+def main(args):
+    tracemalloc.start()
+    results = []
+    for num_works in args.sizes:
+        size_results = benchmark_size(num_works, args)
+        print_results(size_results)
+        results += size_results
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main(parseArguments())
@@ -0,0 +1,334 @@
+""" Local stand-in for the OpenAlex and Namsor APIs, used by the offline benchmarks.
+
+    Serves synthetic (or recorded) responses for the requests the pipeline makes:
+        GET  /sources?search=...                  one source with works_count
+        GET  /works?filter=...&cursor=|page=...   pages of works (cursor or basic paging, sample=, publication_year 
+                                                  filters), or counts with group_by=publication_year,
+                                                  authorships.institutions.id or authorships.countries
+        GET  /institutions?filter=ids.openalex:.. geo of each institution
+        GET  /authors?filter=ids.openalex:...     last known institution and name alternatives
+        POST /namsor/genderBatch                  gender predictions
+    with configurable latency, injected 429 responses and payload sizes. Responses are generated
+    deterministically from the work index, so runs of the same size are comparable.
+
+    usage: python benchmarks/standin.py [--works N] [--port PORT] [--latency SECONDS] ...
+"""
+import json
+import time
+import random
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+FIRST_NAMES = ['maria', 'john', 'wei', 'fatima', 'james', 'anna', 'mohammed', 'sofia', 'david', 'yuki',
+               'elena', 'carlos', 'priya', 'thomas', 'amara', 'lukas', 'chen', 'olga', 'pierre', 'aisha']
+LAST_NAMES = ['Smith', 'Garcia', 'Wang', 'Khan', 'Muller', 'Rossi', 'Tanaka', 'Silva', 'Novak', 'Okafor']
+COUNTRIES = ['US', 'GB', 'DE', 'FR', 'IT', 'CN', 'JP', 'BR', 'IN', 'NG']
+GENDERS = ['male', 'female']
+
+class StandIn():
+    """ Threaded HTTP server answering like OpenAlex (at base_url) and Namsor (at base_url/namsor).
+        Args:
+            num_works: int number of works in the stand-in journal
+            latency: float seconds added to every response, plus up to `jitter` more
+            rate_429: float fraction of requests answered with 429 Too Many Requests
+            retry_after: float seconds sent as Retry-After with each 429
+            authors_per_work, abstract_words: payload size of each work
+            num_authors, num_institutions: distinct entities the works are spread over
+            issue_components: int number of "Back Matter" works served after the journal's works, 
+                              which the pipeline leaves out (a page of only these parses to no rows)
+            recorded: optional path to a saved OpenAlex works response whose works are cycled (with new IDs)
+                      instead of synthetic works
+    """
+    def __init__(self, num_works, latency=0.0, jitter=0.0, rate_429=0.0, retry_after=0.05,
+                 authors_per_work=3, abstract_words=0, num_authors=None, num_institutions=2000,
+                 issue_components=0, recorded=None, seed=0, port=0):
+        self.num_works = num_works
+        self.issue_components = issue_components
+        self.latency, self.jitter = latency, jitter
+        self.rate_429, self.retry_after = rate_429, retry_after
+        self.authors_per_work = authors_per_work
+        self.abstract_words = abstract_words
+        self.num_authors = num_authors or max(1, num_works * authors_per_work // 2)
+        self.num_institutions = num_institutions
+        self.recorded = None
+        if recorded:
+            with open(recorded) as f:
+                self.recorded = json.load(f)['results']
+        self.random = random.Random(seed)
+        self.port = port
+        self.counts = {}        # endpoint -> requests answered
+        self.throttled = 0      # 429 responses sent
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+        self.server = None
+
+    def start(self):
+        """ Starts serving in a background thread, returns the base url.
+        """
+        Handler = type('Handler', (StandInHandler,), {'standin' : self})
+        self.server = ThreadingHTTPServer(('127.0.0.1', self.port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.base_url()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def host(self):
+        return urlparse(self.base_url()).netloc
+
+    def snapshot(self):
+        """ Returns a copy of the request counters, to diff around a stage.
+        """
+        with self.lock:
+            return {'counts' : dict(self.counts), 'throttled' : self.throttled, 'bytes_sent' : self.bytes_sent}
+
+    def record(self, endpoint, throttled=False, size=0):
+        with self.lock:
+            self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+            self.throttled += throttled
+            self.bytes_sent += size
+
+    def throttle(self):
+        """ Sleeps for the configured latency, returns True if this request should get a 429.
+        """
+        with self.lock:
+            delay = self.latency + self.random.uniform(0, self.jitter)
+            throttled = self.random.random() < self.rate_429
+        if delay: time.sleep(delay)
+        return throttled
+
+    # --- responses ---
+
+    def source(self):
+        return {'meta' : {'count' : 1},
+                'results' : [{'id' : 'https://openalex.org/S1', 'display_name' : 'Stand-in Journal',
+                              'works_count' : self.num_works + self.issue_components}]}
+
+    def year(self, i):
+        return 1950 + i % 75
+
+    def works(self, query):
+        """ Returns a page of works for cursor (offset as the cursor) or basic paging,
+            or the number of works per group for group_by (see group_counts).
+        """
+        indices = range(self.num_works + self.issue_components)
+        first, last = year_range(query.get('filter', [''])[0])
+        if first is not None or last is not None:
+            indices = [i for i in indices if (first is None or self.year(i) >= first) and 
+                                             (last is None or self.year(i) <= last)]
+        if 'group_by' in query:
+            return self.group_counts(indices, query['group_by'][0])
+        total = len(indices)
+        if 'sample' in query:
+            total = min(total, int(query['sample'][0]))
+        per_page = int(query.get('per_page', ['25'])[0])
+        if 'cursor' in query:
+            cursor = query['cursor'][0]
+            start = 0 if cursor == '*' else int(cursor)
+        else:
+            start = (int(query.get('page', ['1'])[0]) - 1) * per_page
+        end = min(total, start + per_page)
+        results = [self.work(indices[i]) for i in range(start, end)]
+        next_cursor = str(end) if end < total else None
+        return {'meta' : {'count' : total, 'next_cursor' : next_cursor}, 'results' : results}
+
+    def group_counts(self, indices, field):
+        """ Returns the number of works per publication_year, authorships.institutions.id or 
+            authorships.countries group, at most the 200 largest as OpenAlex does.
+        """
+        counts, names = {}, {}
+        for i in indices:
+            if field == 'publication_year':
+                keys = {str(self.year(i)) : str(self.year(i))}
+            elif field == 'authorships.institutions.id':
+                keys = {institution['id'] : institution.get('display_name') for authorship in self.work(i)['authorships']
+                        for institution in authorship['institutions']}
+            elif field == 'authorships.countries':
+                keys = {'https://openalex.org/countries/' + country : country 
+                        for authorship in self.work(i)['authorships'] for country in authorship['countries']}
+            else:
+                raise Exception("Stand-in does not group works by " + field)
+            for key, name in keys.items():
+                counts[key] = counts.get(key, 0) + 1
+                names[key] = name
+        groups = sorted(counts.items(), key=lambda item: -item[1])
+        return {'meta' : {'count' : len(indices), 'groups_count' : len(groups)}, 
+                'group_by' : [{'key' : key, 'key_display_name' : names[key], 'count' : count} 
+                              for key, count in groups[:200]]}
+
+    def work(self, i):
+        if self.recorded:
+            work = dict(self.recorded[i % len(self.recorded)])
+            work['id'] = 'https://openalex.org/W' + str(i)
+        else:
+            work = self.synthetic_work(i)
+        if i >= self.num_works:
+            work['display_name'] = 'Back Matter'
+        return work
+
+    def synthetic_work(self, i):
+        authorships = []
+        for j in range(self.authors_per_work):
+            author = (i * 7 + j * 13) % self.num_authors
+            institution = (i * 13 + j * 7) % self.num_institutions
+            authorships.append({
+                'author' : {'id' : 'https://openalex.org/A' + str(author), 'display_name' : self.author_name(author)},
+                'institutions' : [{'id' : 'https://openalex.org/I' + str(institution),
+                                   'display_name' : 'Institution ' + str(institution)}],
+                'countries' : [COUNTRIES[institution % len(COUNTRIES)]]})
+        work = {'id' : 'https://openalex.org/W' + str(i), 'display_name' : 'Work ' + str(i),
+                'publication_year' : self.year(i), 'authorships' : authorships}
+        if self.abstract_words:
+            index = {}
+            for position in range(self.abstract_words):
+                index.setdefault('word{}'.format((i + position) % 500), []).append(position)
+            work['abstract_inverted_index'] = index
+        return work
+
+    def author_name(self, author):
+        """ Every tenth author is listed by initials, so alternative names are looked up.
+        """
+        first = FIRST_NAMES[author % len(FIRST_NAMES)]
+        last = LAST_NAMES[author % len(LAST_NAMES)]
+        if author % 10 == 0:
+            return first[0].upper() + '. ' + last
+        return first.capitalize() + ' ' + last
+
+    def ids(self, query):
+        filter = query.get('filter', [''])[0]
+        return filter.split('ids.openalex:', 1)[-1].split('|') if 'ids.openalex:' in filter else []
+
+    def institutions(self, query):
+        results = []
+        for id in self.ids(query):
+            number = int(id.lstrip('I'))
+            geo = None
+            if number % 5: # a fifth of institutions have no geodata
+                geo = {'latitude' : -50 + (number * 37) % 120, 'longitude' : -170 + (number * 53) % 340,
+                       'country_code' : COUNTRIES[number % len(COUNTRIES)]}
+            results.append({'id' : 'https://openalex.org/' + id, 'geo' : geo})
+        return {'meta' : {'count' : len(results)}, 'results' : results}
+
+    def authors(self, query):
+        results = []
+        for id in self.ids(query):
+            number = int(id.lstrip('A'))
+            results.append({'id' : 'https://openalex.org/' + id, 'display_name' : self.author_name(number),
+                            'display_name_alternatives' : [FIRST_NAMES[number % len(FIRST_NAMES)].capitalize() +
+                                                           ' ' + LAST_NAMES[number % len(LAST_NAMES)]],
+                            'last_known_institutions' : [{'id' : 'https://openalex.org/I' +
+                                                          str(number % self.num_institutions)}]})
+        return {'meta' : {'count' : len(results)}, 'results' : results}
+
+    def genders(self, payload):
+        predictions = []
+        for name in payload['personalNames']:
+            gender = GENDERS[sum(map(ord, name['firstName'])) % 2]
+            predictions.append({'id' : name['id'], 'firstName' : name['firstName'],
+                                'likelyGender' : gender, 'probabilityCalibrated' : 0.9})
+        return {'personalNames' : predictions}
+
+def year_range(filter):
+    """ Given an OpenAlex filter, returns the (first, last) publication years its 
+        publication_year:>X and publication_year:<Y filters allow, None for no limit.
+    """
+    first, last = None, None
+    for part in filter.split(','):
+        if part.startswith('publication_year:>'):
+            first = max(first or 0, int(part.split('>')[1]) + 1)
+        elif part.startswith('publication_year:<'):
+            last = min(last if last is not None else 10**4, int(part.split('<')[1]) - 1)
+    return first, last
+
+class StandInHandler(BaseHTTPRequestHandler):
+    standin = None
+    protocol_version = 'HTTP/1.1' # keep-alive, as with the real APIs
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        endpoint = url.path.rstrip('/').rsplit('/', 1)[-1]
+        responses = {'sources' : lambda: self.standin.source(),
+                     'works' : lambda: self.standin.works(query),
+                     'institutions' : lambda: self.standin.institutions(query),
+                     'authors' : lambda: self.standin.authors(query)}
+        self.answer(endpoint, responses.get(endpoint))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        payload = json.loads(self.rfile.read(length) or b'{}')
+        endpoint = urlparse(self.path).path.rstrip('/').rsplit('/', 1)[-1]
+        respond = (lambda: self.standin.genders(payload)) if endpoint == 'genderBatch' else None
+        self.answer(endpoint, respond)
+
+    def answer(self, endpoint, respond):
+        if respond is None:
+            return self.send_body(404, b'{"error": "not found"}')
+        if self.standin.throttle():
+            self.standin.record(endpoint, throttled=True)
+            return self.send_body(429, b'{"error": "rate limited"}',
+                                  {'Retry-After' : str(self.standin.retry_after)})
+        body = json.dumps(respond()).encode()
+        self.standin.record(endpoint, size=len(body))
+        self.send_body(200, body)
+
+    def send_body(self, status, body, headers={}):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # quiet: the benchmarks report request counts instead
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenAlex and Namsor APIs")
+    parser.add_argument("--works", dest="num_works", type=int, default=1000, help="works in the journal")
+    add_standin_arguments(parser)
+    parser.add_argument("--port", type=int, default=8000, help="port to serve on (default 8000)")
+    return parser.parse_args()
+
+def add_standin_arguments(parser):
+    """ Adds the stand-in's latency, 429 and payload options to an argument parser 
+        (the number of works is left to each caller, e.g. --sizes in pipeline.py).
+    """
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many more seconds per response")
+    parser.add_argument("--rate_429", type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument("--retry_after", type=float, default=0.05, help="Retry-After seconds sent with each 429")
+    parser.add_argument("--authors_per_work", type=int, default=3, help="authorships on each work")
+    parser.add_argument("--abstract_words", type=int, default=0, help="words in each work's abstract")
+    parser.add_argument("--num_institutions", type=int, default=2000, help="distinct institutions")
+    parser.add_argument("--issue_components", type=int, default=1, 
+                        help="'Back Matter' works served after the journal's works (default 1)")
+    parser.add_argument("--recorded", default=None,
+                        help="path to a saved OpenAlex works response to serve instead of synthetic works")
+
+def standin_options(args):
+    """ Returns the StandIn keyword arguments from parsed stand-in options.
+    """
+    return {'latency' : args.latency, 'jitter' : args.jitter, 'rate_429' : args.rate_429,
+            'retry_after' : args.retry_after, 'authors_per_work' : args.authors_per_work,
+            'abstract_words' : args.abstract_words, 'num_institutions' : args.num_institutions,
+            'issue_components' : args.issue_components,
+            'recorded' : args.recorded}
+
+if __name__ == "__main__":
+    args = parseArguments()
+    standin = StandIn(args.num_works, port=args.port, **standin_options(args))
+    print("Serving OpenAlex at {0} and Namsor at {0}/namsor".format(standin.start()))
+    try:
+        while True: time.sleep(3600)
+    except KeyboardInterrupt:
+        standin.stop()
@@ -0,0 +1,62 @@
+""" Startup-time benchmark for main.py.
+
+    Measures the cold start of a run without maps or gender plots: a fresh interpreter importing
+    main and parsing its arguments, repeated a few times. Exits nonzero if the median time is
+    over budget, or if a heavy dependency that run does not need (pygmt, matplotlib, scipy) was imported.
+
+    usage: python benchmarks/startup.py [--budget SECONDS] [--repeat N]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+DEFERRED_MODULES = ['pygmt', 'matplotlib', 'scipy'] # only needed by -m, -g plots, or not at all
+STARTUP = """
+import sys, json
+sys.argv = ['main.py', 'config.json', 'journal']
+import main
+main.parseArguments()
+print(json.dumps([name for name in {modules} if name in sys.modules]))
+""".format(modules=DEFERRED_MODULES)
+
+def cold_start():
+    """ Runs one startup in a fresh interpreter, returns (seconds, list of deferred modules it imported)
+    """
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', STARTUP], cwd=SRC, capture_output=True, text=True)
+    seconds = time.perf_counter() - start
+    if result.returncode != 0:
+        raise Exception("Startup failed:\n" + result.stderr)
+    return seconds, json.loads(result.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold start time of main.py for a run without maps")
+    parser.add_argument("--budget", type=float, default=2.0, help="maximum median startup in seconds (default 2.0)")
+    parser.add_argument("--repeat", type=int, default=5, help="number of cold starts to time (default 5)")
+    args = parser.parse_args()
+
+    timings, imported = [], set()
+    for _ in range(args.repeat):
+        seconds, modules = cold_start()
+        timings.append(seconds)
+        imported.update(modules)
+
+    median = statistics.median(timings)
+    print("startup: median {:.3f}s, min {:.3f}s, max {:.3f}s over {} runs (budget {:.3f}s)"
+          .format(median, min(timings), max(timings), args.repeat, args.budget))
+    failed = False
+    if imported:
+        print("FAIL: imported deferred modules at startup: " + ', '.join(sorted(imported)))
+        failed = True
+    if median > args.budget:
+        print("FAIL: startup over budget")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
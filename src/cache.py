@@ -0,0 +1,140 @@
+import sqlite3
+import threading
+import time
+import numpy as np
+
+SQL_BATCH_SIZE = 500 # stay under SQLite's limit on variables per query
+STORE_CHUNK_SIZE = 2000 # lookups requested between saves to a store, so an interrupted run keeps most of them
+
+class GeodataStore():
+    """ On-disk store of Institution ID -> (latitude, longitude, country code) 
+        and Author ID -> last known Institution ID, shared across journals and runs. 
+        Entries older than `ttl_days` are treated as missing.
+        Institutions without geodata and Authors without an institution are stored too, so they are not requested again.
+    """
+    def __init__(self, path, ttl_days=180):
+        self.path = path
+        self.ttl = ttl_days * 24 * 60 * 60
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS institutions (
+                                        id TEXT PRIMARY KEY, 
+                                        latitude REAL, 
+                                        longitude REAL, 
+                                        country TEXT, 
+                                        updated REAL)""")
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS authors (
+                                        id TEXT PRIMARY KEY, 
+                                        institution TEXT, 
+                                        updated REAL)""")
+
+    def get_many(self, ids):
+        """ Given a list of Institution short IDs, 
+            returns a dict of ID -> (latitude, longitude, country code) for unexpired stored IDs.
+        """
+        geodata = {}
+        oldest = time.time() - self.ttl
+        with self.lock:
+            for i in range(0, len(ids), SQL_BATCH_SIZE):
+                batch = ids[i:i + SQL_BATCH_SIZE]
+                rows = self.connection.execute(
+                    "SELECT id, latitude, longitude, country FROM institutions WHERE updated >= ? AND id IN ({})"
+                        .format(','.join('?' * len(batch))), [oldest] + batch)
+                for id, latitude, longitude, country in rows:
+                    geodata[id] = (nan_if_none(latitude), nan_if_none(longitude), country)
+        return geodata
+
+    def put_many(self, geodata):
+        """ Given a dict of ID -> (latitude, longitude, country code), stores or refreshes each entry.
+        """
+        now = time.time()
+        rows = [(id, none_if_nan(latitude), none_if_nan(longitude), country, now) 
+                for id, (latitude, longitude, country) in geodata.items()]
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO institutions VALUES (?, ?, ?, ?, ?)", rows)
+
+    def get_authors(self, ids):
+        """ Given a list of Author short IDs, 
+            returns a dict of ID -> last known Institution short ID (or None) for unexpired stored IDs.
+        """
+        institutions = {}
+        oldest = time.time() - self.ttl
+        with self.lock:
+            for i in range(0, len(ids), SQL_BATCH_SIZE):
+                batch = ids[i:i + SQL_BATCH_SIZE]
+                rows = self.connection.execute(
+                    "SELECT id, institution FROM authors WHERE updated >= ? AND id IN ({})"
+                        .format(','.join('?' * len(batch))), [oldest] + batch)
+                institutions.update(rows)
+        return institutions
+
+    def put_authors(self, institutions):
+        """ Given a dict of Author ID -> Institution ID (or None), stores or refreshes each entry.
+        """
+        now = time.time()
+        rows = [(id, institution, now) for id, institution in institutions.items()]
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO authors VALUES (?, ?, ?)", rows)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+class GenderStore():
+    """ On-disk, append-only store of first name -> (predicted gender, probability, count), 
+        shared across journals and runs. Predictions are never overwritten; `count` is the number
+        of runs in which the name was looked up. Safe to share between processes writing at once.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL") # readers don't block the writer
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS genders (
+                                        name TEXT PRIMARY KEY, 
+                                        gender TEXT, 
+                                        probability REAL, 
+                                        count INTEGER, 
+                                        updated REAL)""")
+
+    def get_many(self, names):
+        """ Given a list of first names, returns a dict of name -> (gender, probability) for stored names.
+        """
+        genders = {}
+        with self.lock:
+            for i in range(0, len(names), SQL_BATCH_SIZE):
+                batch = names[i:i + SQL_BATCH_SIZE]
+                rows = self.connection.execute(
+                    "SELECT name, gender, probability FROM genders WHERE name IN ({})"
+                        .format(','.join('?' * len(batch))), batch)
+                for name, gender, probability in rows:
+                    genders[name] = (gender, probability)
+        return genders
+
+    def add_many(self, genders):
+        """ Given a dict of name -> (gender, probability), appends names not already stored. 
+            A name stored meanwhile by another writer keeps its first prediction.
+        """
+        now = time.time()
+        rows = [(name, gender, probability, 0, now) for name, (gender, probability) in genders.items()]
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO genders VALUES (?, ?, ?, ?, ?)", rows)
+
+    def count(self, names):
+        """ Given a list of first names looked up in this run, increments their counts.
+        """
+        with self.lock, self.connection:
+            self.connection.executemany("UPDATE genders SET count = count + 1 WHERE name = ?", 
+                                        [(name,) for name in names])
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+def nan_if_none(value):
+    return np.nan if value is None else value
+
+def none_if_nan(value):
+    return None if value is None or np.isnan(value) else value
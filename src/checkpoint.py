@@ -0,0 +1,135 @@
+import os
+import json
+import shutil
+import pandas as pd
+import util
+
+CHECKPOINT_VERSION = 2
+CHECKPOINT_DIR = 'checkpoint'
+STATE_FILE = 'state.json'
+PAGE_FILE = 'page-{:06d}.parquet'
+INDEX_COLUMN = 'abstract_inverted_index' # abstracts not decoded yet (--lazy_abstracts), as JSON text
+
+class Checkpoint():
+    """ Crawl progress of one journal, saved in a `checkpoint` directory next to its saved data
+        so an interrupted run can be resumed (--resume): each parsed page of works as a Parquet file,
+        and a state file with the query, the number of pages saved, the publication year shards of the crawl,
+        and the shard and position (cursor or page number) of the next page. Files are written under 
+        temporary names and then moved into place, so a run stopped mid-write leaves the last complete checkpoint.
+        Geodata and gender lookups are kept in stores inside the checkpoint when no cache is configured.
+    """
+    def __init__(self, data_dst, query):
+        self.path = os.path.join(data_dst, CHECKPOINT_DIR)
+        self.query = query
+        self.pages = 0          # pages saved
+        self.shards = [[None, None]] # publication year ranges crawled (see Data.year_shards)
+        self.shard = 0          # shard of the next page
+        self.position = None    # where the next page starts: cursor, page number, or None for the first page
+        self.done = False       # all pages saved
+
+    def load(self):
+        """ Reads the saved state, returns True if there is a checkpoint to resume.
+            Raises an Exception if it was saved for a different query.
+        """
+        state_path = os.path.join(self.path, STATE_FILE)
+        if not os.path.exists(state_path): return False
+        with open(state_path, 'r') as f:
+            state = json.load(f)
+        if state['version'] != CHECKPOINT_VERSION or state['query'] != self.query:
+            raise Exception("Checkpoint at " + self.path + " was saved for a different query. " +
+                            "Rerun with the same arguments, or without --resume to start over.")
+        self.pages, self.position, self.done = state['pages'], state['position'], state['done']
+        self.shards, self.shard = state['shards'], state['shard']
+        util.info("Resuming from checkpoint: {} pages saved{}.".format(self.pages, ", crawl complete" if self.done else ""))
+        return True
+
+    def page_frames(self):
+        """ Generator over the DataFrames of the saved pages, in order, reading one page at a time.
+        """
+        for page in range(1, self.pages + 1):
+            yield load_page(self.page_path(page))
+
+    def load_works(self):
+        """ Returns one DataFrame of the works on all saved pages, or None if no pages are saved.
+            The pages are read and joined as Arrow tables, which hold the works far more compactly than
+            DataFrames, so the works are only held once as a DataFrame.
+        """
+        if not self.pages: return None
+        import pyarrow as pa # deferred: only needed once a crawl is done
+        import pyarrow.parquet as pq
+        tables = [pq.read_table(self.page_path(page)) for page in range(1, self.pages + 1)]
+        schema = pa.unify_schemas([table.schema for table in tables]) # e.g. pages whose lists are all empty
+        for i, table in enumerate(tables):
+            for field in schema: # a resumed crawl may keep abstracts both decoded and as inverted indexes
+                if field.name not in table.column_names:
+                    table = table.append_column(field, pa.nulls(len(table), field.type))
+            tables[i] = table.select(schema.names).cast(schema)
+        works = pa.concat_tables(tables).to_pandas()
+        del tables
+        return restore_indexes(works)
+
+    def save_page(self, page_frame, shard, position):
+        """ Saves the next page of parsed works, from the given shard, and the position of the page after it 
+            in that shard (None if it was the shard's last).
+        """
+        os.makedirs(self.path, exist_ok=True)
+        if 'abstract' in page_frame and any(isinstance(abstract, dict) for abstract in page_frame['abstract']):
+            # inverted indexes are kept as they are, to be decoded once the journal's data is saved
+            page_frame = page_frame.rename(columns={'abstract' : INDEX_COLUMN})
+            page_frame[INDEX_COLUMN] = page_frame[INDEX_COLUMN].map(json.dumps)
+        path = self.page_path(self.pages + 1)
+        page_frame.to_parquet(path + '.tmp', index=False)
+        os.replace(path + '.tmp', path)
+        self.pages += 1
+        self.shard, self.position = shard, position
+        if position is None: # on to the next shard
+            self.shard += 1
+        self.done = self.shard >= len(self.shards)
+        self.save_state()
+
+    def finish(self):
+        """ Marks the crawl complete, e.g. when a page comes back empty.
+        """
+        self.done = True
+        self.save_state()
+
+    def save_state(self):
+        os.makedirs(self.path, exist_ok=True)
+        state_path = os.path.join(self.path, STATE_FILE)
+        with open(state_path + '.tmp', 'w') as f:
+            json.dump({'version' : CHECKPOINT_VERSION, 'query' : self.query, 'pages' : self.pages,
+                       'shards' : self.shards, 'shard' : self.shard, 'position' : self.position, 
+                       'done' : self.done}, f, indent=4)
+        os.replace(state_path + '.tmp', state_path)
+
+    def page_path(self, page):
+        return os.path.join(self.path, PAGE_FILE.format(page))
+
+    def store_path(self, name):
+        """ Returns the path of a store kept with the checkpoint (e.g. 'geodata.sqlite').
+        """
+        os.makedirs(self.path, exist_ok=True)
+        return os.path.join(self.path, name)
+
+    def clear(self):
+        """ Removes the checkpoint, once the journal's data is saved or to start over.
+        """
+        shutil.rmtree(self.path, ignore_errors=True)
+        self.pages, self.shards, self.shard, self.position, self.done = 0, [[None, None]], 0, None, False
+
+def load_page(path):
+    """ Reads a saved page of parsed works, with any abstracts saved as inverted indexes restored to dicts.
+    """
+    return restore_indexes(pd.read_parquet(path))
+
+def restore_indexes(works):
+    """ Given saved works, returns them with abstracts saved as inverted indexes (JSON text) 
+        back in the abstract column as dicts.
+    """
+    if INDEX_COLUMN not in works: return works
+    indexes = works.pop(INDEX_COLUMN).map(lambda index: index if index is None else json.loads(index))
+    if 'abstract' in works:
+        works['abstract'] = works['abstract'].where(indexes.isna(), indexes)
+    else:
+        works['abstract'] = indexes
+    return works
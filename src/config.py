@@ -1,3 +1,9 @@
+import os
+import re
+import copy
+
+import util
+
 class Config():
     def __init__(self, config_json):
         def try_json(keys):
@@ -9,11 +15,20 @@ class Config():
             except KeyError as err:
                 print("Check config file: " + err)
 
+        def optional_json(keys, default=None):
+            result = config_json
+            for key in keys:
+                if key not in result: return default
+                result = result[key]
+            return result
+
         self.email = try_json(['email'])
         self.gender_apikey = try_json(['namsor_key'])
+        # optional: OpenAlex premium API key, needed to request only updated works (-u)
+        self.openalex_apikey = optional_json(['openalex_key'])
 
-        self.gender_src = try_json(['genders', 'src'])
-        self.gender_dst = try_json(['genders', 'dst'])
+        # optional: name -> gender predictions shared across journals and runs
+        self.gender_cache = optional_json(['gender_cache', 'path'])
 
         self.data_src = try_json(['journal_data', 'src'])
         self.data_dst = try_json(['journal_data', 'dst'])
@@ -21,5 +36,39 @@ class Config():
         self.csv = try_json(['output', 'csv'])
         self.map = try_json(['output', 'map'])
         self.gender_plot = try_json(['output', 'gender-plot'])
+        # optional: grid cell size in degrees that map points are aggregated onto (exact locations if unset)
+        self.map_grid = optional_json(['output', 'map_grid'])
+        # optional: extra map regions, name -> [west, east, south, north], each written as map-<name>.png
+        self.map_regions = optional_json(['output', 'map_regions'], default={})
+        # optional: works also written as Parquet
+        self.parquet = optional_json(['output', 'parquet'])
+        # optional: works per country written by -c
+        self.countries = optional_json(['output', 'countries'], 
+                                       default=os.path.join(os.path.dirname(self.csv or ''), 'countries.csv'))
+        # optional: comparison table written by --batch
+        self.comparison = optional_json(['output', 'comparison'], 
+                                        default=os.path.join(os.path.dirname(self.csv or ''), 'comparison.csv'))
+
+        # optional: institution geodata shared across journals and runs
+        self.geodata_cache = optional_json(['geodata_cache', 'path'])
+        self.geodata_ttl_days = optional_json(['geodata_cache', 'ttl_days'], default=180)
+
+
 
+    def for_journal(self, journal_name):
+        """ Returns a copy of the Config whose per-journal paths (saved data and outputs) 
+            are suffixed with the journal name, e.g. data.csv -> data-gesta.csv. 
+            API keys, caches and the comparison table stay shared.
+        """
+        slug = re.sub(r'[^a-z0-9]+', '-', journal_name.lower()).strip('-')
+        suffix = lambda path: util.suffix_path(path, slug)
 
+        config = copy.copy(self)
+        config.data_src = suffix(self.data_src)
+        config.data_dst = suffix(self.data_dst)
+        config.csv = suffix(self.csv)
+        config.parquet = suffix(self.parquet)
+        config.map = suffix(self.map)
+        config.gender_plot = suffix(self.gender_plot)
+        config.countries = suffix(self.countries)
+        return config
@@ -1,13 +1,18 @@
-import requests
 import pandas as pd
-import numpy as np
-from tqdm import tqdm
-from scipy import stats as st
 
 import util
+import stats
+import metrics
 from config import Config
-from geodata import parse_work_geodata, map_points
-from multiRequests import multithr_iterate, api_get, api_post
+from cache import GeodataStore
+from checkpoint import Checkpoint
+from geodata import resolve_geodata, short_id, grid_points, map_series, MAP_REGION, MAP_PROJECTION
+import multiRequests
+from multiRequests import api_get, prefetch_chain
+from writers import open_writers
+
+PER_PAGE = 200 # maximum page size allowed by OpenAlex
+WRITE_CHUNK_SIZE = 5000 # works converted and written to the outputs at a time
 
 def get_journal(journal_name, email):
         """ Returns the OpenAlex Source object of the top result for the input journal name
@@ -17,7 +22,7 @@ def get_journal(journal_name, email):
             Returns:
                 json - OpenAlex Source object for top match in database
         """    
-        url = "https://api.openalex.org/sources?search=" + journal_name + '&mailto=' + email
+        url = multiRequests.OPENALEX_API + "/sources?search=" + journal_name + '&mailto=' + email
         results = api_get(url)
         if len(results['results']) > 0: 
             top_result = results['results'][0]
@@ -26,7 +31,31 @@ def get_journal(journal_name, email):
         else:
             raise Exception("No results found for journal " + journal_name + " in OpenAlex database.")
 
+def authorship_countries(authorship):
+    """ Given an OpenAlex Authorship, returns the country codes of the author's affiliations:
+        its `countries`, or if missing the country codes of its institutions. 
+    """
+    countries = authorship.get('countries') or \
+                [institution.get('country_code') for institution in authorship['institutions']]
+    return util.ordered_unique([country for country in countries if country])
+
+def year_filter(first, last):
+    """ Returns OpenAlex filters (each starting with ',') for publication years from `first` to `last`
+        inclusive, leaving out either end if None.
+    """
+    filters = ''
+    if first: filters += ',publication_year:>' + str(first - 1)
+    if last: filters += ',publication_year:<' + str(last + 1)
+    return filters
+
 class Data():
+    bucket_sizes = (5,) # year bucket sizes aggregated for trends over time
+    # OpenAlex Work fields each stage needs; only the enabled stages' fields are requested
+    stage_fields = {'works' : ['id', 'display_name', 'publication_year', 'authorships'],
+                    'abstracts' : ['abstract_inverted_index'],
+                    'maps' : ['authorships'],
+                    'countries' : ['authorships']}
+
     def __init__(self, args, config_json):
         self.analysis = args
         self.config = Config(config_json)
@@ -36,190 +65,513 @@ class Data():
         self.num_works = journal['works_count']
         self.analysis.journal_name = journal['display_name']
 
-        self.titles = []
-        self.authors = []
-        self.abstracts = []
-        self.years = []
-        self.institution_names = []
-
-        self.latitudes = []
-        self.longitudes = [] 
+        # one row per work; authors, author_ids, institutions and institution_ids hold lists
+        self.works = pd.DataFrame({column : [] for column in self.work_columns()})
+        # when set (YYYY-MM-DD), only works created or updated since then are requested
+        self.updated_since = None
+        # crawl progress saved as pages are parsed, set by iterate_search
+        self.checkpoint = None
 
-    def iterate_search(self):
-        """ 
-        Pages over Works for journal, populating titles, authors, publication years, and abstracts. 
-
-        Args:
-            data: Data object - precondition empty / freshly instantiated
-            source_id: string - OpenAlex ID of the source to analyze
-        Returns:
-            (list[list[institution IDs]], list[list[author IDs]]) -
-            for each work in journal, lists of affiliated institution and author IDs
+    def search_filters(self):
+        """ Returns the OpenAlex filter selecting the journal's works, from the commandline arguments.
         """
-        # only get these fields for items retrieved:
-        fields = 'display_name,authorships,concepts,publication_year,abstract_inverted_index'
         # filter items retrieved by year:
         search_filters = 'locations.source.id:' + self.source_id
-        if self.analysis.start_year:
-            search_filters += ',publication_year:>' + str(self.analysis.start_year - 1)
-        if self.analysis.end_year: 
-            search_filters += ',publication_year:<' + str(self.analysis.end_year + 1)
+        search_filters += year_filter(self.analysis.start_year, self.analysis.end_year)
+        if self.updated_since:
+            search_filters += ',from_updated_date:' + self.updated_since
+        return search_filters
+
+    def works_query(self, shard=None):
+        """ Builds the OpenAlex Works query for the journal from the commandline arguments,
+            without any paging parameters.
+
+            Args:
+                shard: optional [first year, last year] range of publication years to limit the query to
+                       (None for an open end)
+            Returns:
+                str - url of the Works query
+        """
+        # only get the fields needed by the enabled stages:
+        fields = ','.join(self.select_fields())
+        search_filters = self.search_filters()
+        if shard:
+            search_filters += year_filter(*shard)
        
         if self.analysis.sample_size:
             sample_size = str(self.analysis.sample_size) 
             seed = str(42)
-            sampling = 'sample='+ sample_size + '&seed='+ seed
+            sampling = 'sample='+ sample_size + '&seed='+ seed + '&'
         else:
             sampling = ''
         field_selection = 'select=' + fields
         filtering = 'filter=' + search_filters
 
-        works_query_with_page = ('https://api.openalex.org/works?' +
-                                sampling + '&' + \
-                                field_selection + '&' + \
-                                filtering + '&page={}&mailto=' + self.config.email)
-        page = 1
-        has_more_pages = True
-        fewer_than_10k_results = True
-        institution_id_batches, author_id_batches = [], []
-        while has_more_pages and fewer_than_10k_results:
-            # set page value and request page from OpenAlex
-            url = works_query_with_page.format(page)
-            page_with_results = api_get(url)
-            # loop through page of results
-            results = page_with_results['results']
-            for work in results:
-                title = work['display_name']
-                if util.valid_title(title):
-                    authorship_list = self.add_work_basics(work)
-                    institution_ids, author_ids = self.add_authorship(authorship_list)
-                    institution_id_batches.append(institution_ids)
-                    author_id_batches.append(author_ids)
-            page += 1
-            # end loop when either there are no more results on the requested page 
-            # or the next request would exceed 10,000 results
-            page_size = page_with_results['meta']['per_page']
-            has_more_pages = len(results) == page_size
-            fewer_than_10k_results = page_size * page <= 10000
-            
-            if page % 5 == 0:
-                util.info("On page " + str(page) + ".")
+        return (multiRequests.OPENALEX_API + '/works?' +
+                sampling + \
+                field_selection + '&' + \
+                filtering + '&per_page=' + str(PER_PAGE) + \
+                '&mailto=' + self.config.email)
+
+    def with_api_key(self, url):
+        """ Given an OpenAlex url, returns it with the configured API key, if any. 
+            The key is only added as a request is sent, so it stays out of checkpoints and messages.
+        """
+        if self.config.openalex_apikey:
+            return url + '&api_key=' + self.config.openalex_apikey
+        return url
+
+    def enabled_stages(self):
+        """ Returns the names of the stages (keys of stage_fields) enabled by commandline args.
+        """
+        stages = ['works']
+        if self.analysis.abstracts: stages.append('abstracts')
+        if self.analysis.maps: stages.append('maps')
+        if self.analysis.countries: stages.append('countries')
+        return stages
+
+    def select_fields(self):
+        """ Returns the Work fields needed by the enabled stages, without duplicates.
+        """
+        fields = []
+        for stage in self.enabled_stages():
+            fields += [field for field in self.stage_fields[stage] if field not in fields]
+        return fields
+
+    def group_counts(self, field):
+        """ Returns the number of the journal's works in each group of `field` (e.g. publication_year),
+            from one OpenAlex group_by request with the same filters as works_query.
+            OpenAlex returns at most the 200 largest groups.
+
+            Returns:
+                (DataFrame of key, name, count - most works first, int total number of groups)
+        """
+        url = (multiRequests.OPENALEX_API + '/works?filter=' + self.search_filters() + 
+               '&group_by=' + field + '&per_page=200&mailto=' + self.config.email)
+        response = api_get(self.with_api_key(url))
+        if response is None:
+            raise Exception("Request for works grouped by " + field + " failed: " + url)
+        groups = pd.DataFrame({'key' : [group['key'] for group in response['group_by']],
+                               'name' : [group['key_display_name'] for group in response['group_by']],
+                               'count' : [group['count'] for group in response['group_by']]})
+        groups = groups.sort_values('count', ascending=False, kind='stable', ignore_index=True)
+        return groups, response['meta'].get('groups_count') or len(groups)
+
+    @metrics.stage('group_aggregate')
+    def group_aggregate(self):
+        """ Returns the summary statistics that need no per-work data (see stats.aggregate) - works per year, 
+            works per institution and (with -c) per author country - from three OpenAlex group_by requests 
+            instead of the full crawl (--stats_only). Only the largest 200 institutions and countries are listed.
+        """
+        util.info("Counting works with group_by...")
+        years, _ = self.group_counts('publication_year')
+        years = years[years['key'].astype(str).str.isdigit()]
+        works_by_year = pd.DataFrame({'year' : years['key'].astype(int), 'works' : years['count']})
+        institutions, institution_count = self.group_counts('authorships.institutions.id')
+        aggregates = {'works' : int(years['count'].sum()),
+                      'works_by_year' : works_by_year.sort_values('year', ignore_index=True),
+                      'institutions' : pd.DataFrame({'institution' : institutions['name'], 
+                                                     'publications' : institutions['count']}),
+                      'institution_count' : institution_count}
+        if self.analysis.countries:
+            countries, _ = self.group_counts('authorships.countries')
+            aggregates['countries'] = pd.DataFrame({'country' : countries['key'].map(short_id), 
+                                                    'works' : countries['count']})
+        return aggregates
+
+    def year_shards(self):
+        """ Splits the journal's works into --shards disjoint ranges of publication years 
+            with about the same number of works each, from a count of works per year.
+            The first and last ranges are open-ended, so works of years missing from the count are kept.
+
+            Returns:
+                list[[first year, last year]] - None for an open end; one open range [None, None] 
+                when not sharding (a single shard, or a sample, which OpenAlex draws from the whole query)
+        """
+        if self.analysis.shards <= 1 or self.analysis.sample_size:
+            return [[None, None]]
+        counts, _ = self.group_counts('publication_year')
+        years = sorted((int(year), count) for year, count in zip(counts['key'], counts['count']) if str(year).isdigit())
+        total = sum(count for _, count in years)
+        shards, first, cumulative = [], None, 0
+        for year, count in years[:-1]:
+            cumulative += count
+            if cumulative >= total * (len(shards) + 1) / self.analysis.shards:
+                shards.append([first, year])
+                first = year + 1
+        shards.append([first, None])
+        util.info("Crawling {} works in {} shards by publication year.".format(total, len(shards)))
+        return shards
+
+    def work_pages(self, position=None, shard=None):
+        """ Generator over pages of Works for the journal, at the maximum page size. 
+            Full crawls use cursor paging, which has no limit on the number of results;
+            samples (at most 10,000 works) use basic paging, since OpenAlex does not cursor over samples.
+            Raises an Exception if a page cannot be requested (after retries).
+
+            Args:
+                position: cursor or page number to start from (as yielded with an earlier page), 
+                          or None to start at the first page
+                shard: optional range of publication years to request (see works_query)
+            Yields:
+                (list[OpenAlex Work], position) - the results on each page, 
+                and the position of the next page (None after the last page)
+        """
+        works_query = self.works_query(shard)
+        if self.analysis.sample_size:
+            page = position or 1
+            while True:
+                results = self.request_page(works_query + '&page=' + str(page))
+                page += 1
+                last = len(results) < PER_PAGE or PER_PAGE * (page - 1) >= self.analysis.sample_size
+                yield results, None if last else page
+                if last:
+                    return
+        else:
+            cursor = position or '*'
+            while cursor:
+                page_with_results = self.request_page(works_query + '&cursor=' + cursor, results_only=False)
+                results = page_with_results['results']
+                if not results: 
+                    return
+                cursor = page_with_results['meta']['next_cursor']
+                yield results, cursor
+
+    def request_page(self, url, results_only=True):
+        """ Requests a page of Works, returning its results (or the whole response).
+            Raises an Exception if the request failed, rather than losing the rest of the crawl.
+        """
+        page_with_results = api_get(self.with_api_key(url))
+        if page_with_results is None:
+            raise Exception("Request for a page of works failed: " + url + 
+                            "\nRerun with --resume to continue from the last saved page.")
+        return page_with_results['results'] if results_only else page_with_results
+
+    def work_columns(self):
+        """ Returns the names of the columns parsed from each work, as dictated by commandline args.
+        """
+        columns = ['id', 'title', 'year', 'authors', 'author_ids', 'institutions', 'institution_ids']
+        if self.analysis.abstracts:
+            columns.append('abstract')
+        if self.analysis.countries:
+            columns.append('countries')
+        return columns
+
+    def snapshot_columns(self):
+        """ Returns the names of the columns needed from saved data for the requested outputs.
+        """
+        columns = self.work_columns()
+        if self.analysis.maps:
+            columns += ['latitude', 'longitude', 'country']
+        return columns
+
+    @metrics.stage('iterate_search')
+    def iterate_search(self):
+        """ 
+        Pages over Works for journal, populating self.works with one row per work: 
+        ID, title, publication year, authors, institutions and (with -a) abstract. 
+        Pages are requested and parsed in the background (up to --prefetch pages ahead) 
+        while earlier pages are written, and each parsed page is appended to the CSV output 
+        right away, so a run that stops early still leaves the works crawled so far.
+        Each parsed page is also saved to the journal's checkpoint rather than kept in memory, and self.works 
+        is read back from the checkpoint once the crawl is done; with --resume, the crawl continues after 
+        the pages saved by an interrupted run.
+        With --shards, ranges of publication years (see year_shards) are requested concurrently, 
+        under the shared rate limit, and their pages are parsed in order of year.
+        """
+        self.checkpoint = Checkpoint(self.config.data_dst, self.works_query())
+        if not (self.analysis.resume and self.checkpoint.load()):
+            self.checkpoint.clear()
+            self.checkpoint.shards = self.year_shards()
+        writers = [] 
+        if not self.updated_since: # keep the full outputs of the saved data while updating
+            writers = open_writers(self.config.csv, self.config.parquet) # partial output, replaced by display_data
+        try:
+            if writers:
+                for page_frame in self.checkpoint.page_frames():
+                    for writer in writers:
+                        writer.write(self.csv_frame(page_frame, partial=True))
+            if not self.checkpoint.done:
+                for page, (page_frame, shard, position) in enumerate(self.shard_pages(), start=self.checkpoint.pages + 1):
+                    for writer in writers:
+                        writer.write(self.csv_frame(page_frame, partial=True))
+                    self.checkpoint.save_page(page_frame, shard, position)
+                    
+                    if page % 5 == 0:
+                        util.info("On page " + str(page) + ".")
+                self.checkpoint.finish()
+        finally:
+            for writer in writers:
+                writer.close()
         
-        return institution_id_batches, author_id_batches
+        # parsed pages are only kept in the checkpoint while crawling, and read back once at the end
+        works = self.checkpoint.load_works()
+        if works is not None:
+            self.works = works
+
+    def shard_pages(self):
+        """ Generator over the parsed pages of the shards not yet saved to the checkpoint, in shard order.
+            Every shard is requested and parsed at once in the background; the first holds up to --prefetch pages 
+            ahead of the caller, and later shards keep their parsed pages (much smaller than the raw results)
+            until the caller reaches them.
+
+            Yields:
+                (DataFrame, int, position) - each page parsed (see parse_page), the index of its shard, 
+                and the position of the next page of that shard (see work_pages)
+        """
+        def tagged(shard, position):
+            for results, next_position in self.work_pages(position, self.checkpoint.shards[shard]):
+                yield self.parse_page(results), shard, next_position
+        first = self.checkpoint.shard
+        shards = [tagged(first, self.checkpoint.position)] + \
+                 [tagged(shard, None) for shard in range(first + 1, len(self.checkpoint.shards))]
+        return prefetch_chain(shards, depths=[self.analysis.prefetch] + [None] * (len(shards) - 1))
+
+    def upsert_works(self, saved_works):
+        """ Given previously saved works, merges them with the freshly crawled self.works:
+            crawled works replace saved works with the same ID, and the rest are kept.
+        """
+        kept = saved_works[~saved_works['id'].isin(self.works['id'])]
+        util.info("Updated {} works, {} new.".format(len(saved_works) - len(kept), 
+                                                     len(self.works) - (len(saved_works) - len(kept))))
+        self.works = pd.concat([kept, self.works], ignore_index=True)
+
+    def parse_page(self, results):
+        """ Given a page of OpenAlex Work objects, returns a DataFrame with a row for each work with a valid title.
+            Abstracts are decoded as the page is parsed, or with --lazy_abstracts kept as 
+            inverted indexes until the journal's data is saved (see decode_abstracts).
+        """
+        columns = {column : [] for column in self.work_columns()}
+        # loop through page of results
+        for work in results:
+            title = work['display_name']
+            if util.valid_title(title):
+                authorship_list = self.add_work_basics(work, columns)
+                self.add_authorship(authorship_list, columns)
+        if self.analysis.abstracts and not self.analysis.lazy_abstracts:
+            columns['abstract'] = util.decode_abstracts(columns['abstract'])
+        # explicit dtypes, so a page of only issue components still matches the other pages
+        return pd.DataFrame({column : pd.Series(values, dtype='Int64' if column == 'year' else object) 
+                             for column, values in columns.items()})
     
-    def populate_additional_data(self, institution_ids, author_ids):
-        """ Given list of institution IDs and list of author IDs, populates the Data object
-            with geodata if indicated by commandline arguments. 
+    def populate_additional_data(self):
+        """ Populates the Data object's works with geodata if indicated by commandline arguments. 
         """
         if self.analysis.maps:
-            self.add_geodata(institution_ids, author_ids) 
+            self.add_geodata() 
      
-    def add_work_basics(self, work):
-        """ Given a Work object and Data object to fill, adds title, year, and abstract to self, 
+    def add_work_basics(self, work, columns):
+        """ Given a Work object and the columns of a page to fill, adds ID, title, year, and abstract, 
             and returns list of Authorship objects
             Args:
                 work: single OpenAlex Work object
+                columns: dict of column name -> list of values
             Returns:
                 authorship_list : list of the work's associated Authorship objects
         """
+        columns['id'].append(work['id'])
+
         title = work['display_name']
         if not title: title = 'NA'
-        self.titles.append(title)
+        columns['title'].append(title)
 
-        year = str(work['publication_year'])
-        if not year: year = 'NA'
-        self.years.append(year)
+        columns['year'].append(work['publication_year']) # None if unknown
 
-        if self.analysis.abstracts:
-            inverted_index = work['abstract_inverted_index']
-            words = util.decode_inverted(inverted_index)
-            text = ' '.join(words)
-            self.abstracts.append(text)
+        if self.analysis.abstracts: # decoded a page at a time (see parse_page)
+            columns['abstract'].append(work['abstract_inverted_index'])
             
         authorship_list = work['authorships']
         return authorship_list
 
-    def add_authorship(self, authorships):
-        """ Given list of OpenAlex Authorship json for one Work,
-            adds Authorship information to Data object - names of authors, their institutions.
-            Returns lists of institution IDs and author IDs to parse for geodata.
-            The first Author in the list whose institution has geodata will be mapped. 
+    def add_authorship(self, authorships, columns):
+        """ Given list of OpenAlex Authorship json for one Work and the columns of a page to fill,
+            adds Authorship information - names and IDs of authors, and of their institutions.
+            The institution and author IDs are used to find geodata:
+            the first Author in the list whose institution has geodata will be mapped. 
+            With -c, also adds the country codes of each authorship (see authorship_countries).
             Args: 
                 authorships: list[OpenAlex Authorship]
+                columns: dict of column name -> list of values
         """
-        if not authorships:
-            self.authors.append('NA')
-            self.institution_names.append('NA')
-            return [], []
-        author_names, institution_names, institution_ids, author_ids = [], [], [], []
-        for authorship in authorships:
+        author_names, institution_names, institution_ids, author_ids, countries = [], [], [], [], []
+        for authorship in authorships or []:
             author_names.append(authorship['author']['display_name'])
             author_ids.append(authorship['author']['id'])
             for institution in authorship['institutions']:
                 institution_names.append(institution['display_name'])
                 institution_ids.append(institution['id'])
+            if 'countries' in columns:
+                countries += authorship_countries(authorship)
 
-        author_string = util.namelist2string(author_names)
-        institution_string = util.namelist2string(institution_names)
-        self.authors.append(author_string) 
-        self.institution_names.append(institution_string)
-  
-        return institution_ids, author_ids                       
+        columns['authors'].append(author_names) 
+        columns['author_ids'].append(author_ids)
+        columns['institutions'].append(institution_names)
+        columns['institution_ids'].append(institution_ids)
+        if 'countries' in columns:
+            columns['countries'].append(countries)
 
-    def add_geodata(self, institution_ids, author_ids):
-        """ Given a list of OpenAlex Institution IDs and Author IDs,
-            sets the Data object's latitudes and longitudes list to the results 
-            # TODO: documentation
+    @metrics.stage('add_geodata')
+    def add_geodata(self):
+        """ Given, for each work, a list of OpenAlex Institution IDs and Author IDs,
+            adds latitude, longitude and country columns to works with the location of each work 
+            (see geodata.resolve_geodata).
         """
         util.info("Retrieving geodata...")      
-        results = multithr_iterate(list(zip(institution_ids, author_ids)), 
-                                                parse_work_geodata, 
-                                                batch_size=1, max_workers=2, tuples=True) #OpenAlex rate limiter can't handle workers > 2
-
-        self.latitudes = [result[0] for result in results]
-        self.longitudes = [result[1] for result in results]
-
-    def print_stats(self):
-        institution_dict = {}
-        for group in self.institution_names:
-            for institution in list(set(group.split(';'))): # unique institutions for a work
-                if institution != 'NA':
-                    util.increment(institution, institution_dict)
-        ranked_institutions = list(institution_dict.items())
-        ranked_institutions.sort(key = lambda kv : kv[1], reverse=True) 
+        store = None
+        path = self.config.geodata_cache or self.checkpoint_store('geodata.sqlite')
+        if path:
+            store = GeodataStore(path, ttl_days=self.config.geodata_ttl_days)
+        results = resolve_geodata(self.works['institution_ids'].tolist(), self.works['author_ids'].tolist(), 
+                                  self.config.email, max_workers=8, store=store)
+        if store: store.close()
+
+        self.works['latitude'] = [result[0] for result in results]
+        self.works['longitude'] = [result[1] for result in results]
+        self.works['country'] = [result[2] for result in results]
 
+    def checkpoint_store(self, name):
+        """ Returns the path of a store kept with the crawl checkpoint, so that lookups are not 
+            repeated on --resume when no cache is configured (None if the works were not crawled).
+        """
+        return self.checkpoint.store_path(name) if self.checkpoint else None
+
+    @metrics.stage('aggregate')
+    def aggregate(self):
+        """ Returns summary statistics of the works as DataFrames (see stats.aggregate).
+        """
+        return stats.aggregate(self.works, bucket_sizes=self.bucket_sizes)
+
+    def print_stats(self, aggregates=None):
+        if aggregates is None: aggregates = self.aggregate()
         print("\n{} Summary".format(self.analysis.journal_name))
         print("Total Works Count: {}".format(self.num_works))
-        print("Works sampled: {}".format(len(self.titles)))
+        print("Works sampled: {}".format(aggregates['works']))
+        works_by_year = aggregates['works_by_year']
+        if len(works_by_year):
+            peak = works_by_year.loc[works_by_year['works'].idxmax()]
+            print("Publication years: {}-{}, most works in {} ({})".format(works_by_year['year'].iloc[0], 
+                  works_by_year['year'].iloc[-1], peak['year'], peak['works']))
         print("Institutions with most publications:")        
-        for inst in ranked_institutions[:5]:
-            print("     {}, {} publications".format(inst[0].strip(), inst[1]))
-                             
-    def display_data(self):
-        """ Displays visualizations and writes data CSV as dictated by commandline args.
+        for institution, count in aggregates['institutions'].head(5).itertuples(index=False):
+            print("     {}, {} publications".format(institution, count))
+        if 'countries' in aggregates:
+            print("Countries with most works:" if self.analysis.countries else "Countries with most located works:")
+            for country, count in aggregates['countries'][['country', 'works']].head(5).itertuples(index=False):
+                print("     {}, {} works".format(country, count))
+
+    def summary(self, aggregates=None):
+        """ Returns a dict of summary statistics for comparing journals.
+        """
+        if aggregates is None: aggregates = self.aggregate()
+        institutions = aggregates['institutions']
+        summary = {'journal' : self.analysis.journal_name,
+                   'source_id' : self.source_id,
+                   'works_count' : self.num_works,
+                   'works_analyzed' : aggregates['works'],
+                   'authorships' : aggregates.get('authorships', 'NA'), # not counted by --stats_only
+                   'institutions' : aggregates.get('institution_count', len(institutions)),
+                   'top_institution' : institutions['institution'].iloc[0] if len(institutions) else 'NA'}
+        if self.analysis.maps:
+            summary['fraction_located'] = self.works['latitude'].notna().mean()
+        if 'countries' in aggregates:
+            countries = aggregates['countries']
+            summary['top_country'] = countries['country'].iloc[0] if len(countries) else 'NA'
+        if self.analysis.countries:
+            summary['countries'] = len(aggregates['countries'])
+            summary['fraction_international'] = aggregates.get('fraction_international', 'NA')
+        return summary
+
+    def csv_frame(self, works, partial=False):
+        """ Given works (all or a chunk of them), returns them as written to the CSV: 
+            multi-valued columns joined by '; ', with columns dictated by commandline args.
+            Columns not collected yet (e.g. geodata while crawling) are left out, and so are
+            abstracts not decoded yet (--lazy_abstracts) in the partial output written while crawling.
         """
-        dict = {'author' : self.authors, 
-                'title' : self.titles, 
-                'year' : self.years,
-                'institution' : self.institution_names}
+        dict = {'author' : works['authors'].map(util.namelist2string), 
+                'title' : works['title'], 
+                'year' : works['year'],
+                'institution' : works['institutions'].map(util.namelist2string)}
+
+        if self.analysis.countries:
+            dict['country'] = works['countries'].map(lambda countries: util.namelist2string(util.ordered_unique(countries)))
         
-        if self.analysis.abstracts: 
-            dict['abstract'] = self.abstracts
+        if self.analysis.abstracts and not (partial and self.analysis.lazy_abstracts): 
+            dict['abstract'] = util.decode_abstracts(works['abstract'])
         
-        if self.analysis.maps:
-            dict['latitude'] = self.latitudes
-            dict['longitude'] = self.longitudes
+        if self.analysis.maps and 'latitude' in works:
+            dict['latitude'] = works['latitude']
+            dict['longitude'] = works['longitude']
+
+        return pd.DataFrame(dict)
+
+    @metrics.stage('write_data')
+    def write_data(self):
+        """ Writes the CSV (and Parquet output, if configured) in chunks of WRITE_CHUNK_SIZE works,
+            so only one chunk is converted at a time. The finished files replace the partial output 
+            written while crawling.
+        """
+        self.decode_abstracts()
+        writers = open_writers(self.config.csv, self.config.parquet, atomic=True)
+        for start in range(0, len(self.works), WRITE_CHUNK_SIZE):
+            chunk = self.csv_frame(self.works.iloc[start:start + WRITE_CHUNK_SIZE])
+            for writer in writers:
+                writer.write(chunk)
+        for writer in writers:
+            writer.close()
+                             
+    def decode_abstracts(self):
+        """ Replaces abstracts still held as inverted indexes (--lazy_abstracts) with their text, 
+            so the snapshot and the outputs decode each abstract only once.
+        """
+        if 'abstract' in self.works:
+            self.works['abstract'] = util.decode_abstracts(self.works['abstract'])
 
-        df = pd.DataFrame(dict)
-        util.info(df.head())
+    def display_data(self, aggregates=None):
+        """ Displays visualizations and writes data CSV as dictated by commandline args.
+        """
+        util.info(self.csv_frame(self.works.head()))
 
         util.info("Writing csv...")
-        df.to_csv(self.config.csv)
+        self.write_data()
+
+        if self.analysis.countries:
+            self.write_countries(aggregates)
 
         if self.analysis.maps:
             util.info("Mapping points...")
-            map_dict = {'latitude' : self.latitudes, 'longitude' : self.longitudes} 
-            map_df = pd.DataFrame(map_dict)
-            df = map_df.groupby(['longitude', 'latitude']).size().reset_index(name='counts')
-            map_points(df, self.config.map)
-            util.info("Map created at " + self.config.map + ".")
+            with metrics.stage('map_points'):
+                paths = map_series(self.map_jobs())
+            util.info("Maps created at " + ', '.join(paths) + ".")
+
+    def write_countries(self, aggregates=None):
+        """ Writes the works per country (one row per ISO country code, ready for a choropleth map)
+            to the countries csv, and the works per country and year next to it (e.g. countries-by-year.csv)
+            unless only group_by counts were requested (--stats_only).
+        """
+        if aggregates is None: aggregates = self.aggregate()
+        aggregates['countries'].to_csv(self.config.countries, index=False)
+        util.info("Country table written to " + self.config.countries + ".")
+        if 'countries_by_year' in aggregates:
+            by_year_path = util.suffix_path(self.config.countries, 'by-year')
+            aggregates['countries_by_year'].to_csv(by_year_path, index=False)
+            util.info("Country table by year written to " + by_year_path + ".")
+
+    def map_jobs(self):
+        """ Returns the map_points arguments of every map to render: the full map and each configured 
+            region, and with --map_decades the same again for each decade's works.
+        """
+        series = [(None, self.works)]
+        if self.analysis.map_decades:
+            decades = self.works['year'] // 10 * 10
+            series += [("{}s".format(decade), works) for decade, works in self.works.groupby(decades)]
+        regions = [(None, MAP_REGION)] + list(self.config.map_regions.items())
+
+        jobs = []
+        for label, works in series:
+            points = grid_points(works['latitude'], works['longitude'], self.config.map_grid)
+            for name, region in regions:
+                suffix = '-'.join(part for part in (name, label) if part)
+                path = util.suffix_path(self.config.map, suffix) if suffix else self.config.map
+                title = "{} ({})".format(self.analysis.journal_name, label) if label else None
+                jobs.append((points, path, region, MAP_PROJECTION, title))
+        return jobs
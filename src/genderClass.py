@@ -1,135 +1,128 @@
-import pandas as pd
-import matplotlib.pyplot as plt
-import os
+import re
+import unicodedata
 
 import util
-from dataClass import Data
-from geodata import map_points
-from multiRequests import multithr_iterate, api_post
+import stats
+import metrics
+from dataclass import Data
+from geodata import short_id, OPENALEX_IDS_PER_REQUEST
+from cache import GenderStore, STORE_CHUNK_SIZE
+import multiRequests
+from multiRequests import batch_iterate, api_get, api_get_async, api_post, api_post_async
+
+NAMSOR_BATCH_SIZE = 100 # maximum names per genderBatch request
+HONORIFICS = {'dr', 'prof', 'professor', 'mr', 'mrs', 'ms', 'mx', 'miss', 'sir', 'dame', 
+              'rev', 'fr', 'lord', 'lady', 'hon'}
 
 class GenderData(Data):
-    def __init__(self, args, config_json):
-        super().__init__(args, config_json)
-        #gender_strings: list[] of predicted genders of Work authors
-        #  s.t. each string is ';'-separated genders from same Work
-        self.gender_strings = []
-        self.genders = []
-
-    def populate_additional_data(self, institution_ids, author_ids):
-        """ Given list of institution IDs and list of author IDs, populates the GenderData object
-            with gender data, as well as geodata if indicated by commandline arguments. 
+    stage_fields = {**Data.stage_fields, 'gender' : ['authorships']}
+
+    def enabled_stages(self):
+        return super().enabled_stages() + ['gender']
+
+    def populate_additional_data(self):
+        """ Populates the GenderData object's works with predicted genders, 
+            as well as geodata if indicated by commandline arguments. 
         """
         self.predict_genders()
 
         if self.analysis.maps:
-            self.add_geodata(institution_ids, author_ids) 
+            self.add_geodata() 
 
-    def predict_genders(self, restore_saved=False):
-        """ Given a data object, populates self.gender_strings with predicted genders. 
-            (via Namsor API)
+    def snapshot_columns(self):
+        return super().snapshot_columns() + ['genders']
+
+    @metrics.stage('predict_genders')
+    def predict_genders(self):
+        """ Given a data object, adds a `genders` column of predicted genders for each work's authors. 
+            (via Namsor API, for names not already in the gender store)
+            Authors listed by their initials are looked up by ID for alternative name forms.
 
-            Args:
-                authors: list[str] of author full names
-                restore_saved: read from existing file rather than Namsor requests
             Returns: 
                 None
         """  
         util.info("Predicting genders...")      
-        first_names, inverted_index = full2first_names(self.authors)
+        authors = self.works['authors'].tolist()
+        author_ids = self.works['author_ids'].tolist()
+        initialed_authors = initialed_author_ids(authors, author_ids)
+        alternatives = alternative_names(initialed_authors, self.config.email)
+        first_names, work_names = full2first_names(authors, author_ids, alternatives)
         unique_names = util.unique(first_names)
-        genders_dict = {}
-        if restore_saved and os.path.exists(self.config.gender_src):
-            genders_dict = util.unpickle_data(self.config.gender_src)
-        else:
-            genders_dict = self.get_genders_dict(unique_names)
-            util.pickle_data(genders_dict, dst=self.config.gender_dst)
-
-        ordered_name_tuples = util.decode_inverted(inverted_index, return_tuples=True)
-        ordered_gender_tuples = [(genders_dict[name], i) for name, i in ordered_name_tuples]
-
-        genders = [list for list, _ in util.group_tuples(ordered_gender_tuples)]
-        self.genders = genders
+        genders_dict = self.get_genders_dict(unique_names)
 
-        gender_strings : list[str] = [util.namelist2string(list) for list in genders]
-        self.gender_strings = gender_strings
+        # one gender per author, in author order: 'NA' where no first name could be used
+        self.works['genders'] = [[genders_dict.get(name, 'NA') if name else 'NA' for name in names] 
+                                 for names in work_names]
 
+    @metrics.stage('get_genders_dict')
     def get_genders_dict(self, unique_names):
         """ 
         Given a list of unique first names, returns a dict of names mapped to genders. 
-        Uses Namsor batch requests.
+        Names found in the gender store (if configured) are not requested again; 
+        the rest use Namsor batch requests, and their predictions are added to the store 
+        every STORE_CHUNK_SIZE names.
         """
-        key_and_names = (self.config.gender_apikey, unique_names)
-        genders = multithr_iterate(key_and_names, namsor_request, batch_size=10, max_workers=10)
-        genders_dict = {name : gender for name, gender in zip(unique_names, genders[0][0])}
+        path = self.config.gender_cache or self.checkpoint_store('genders.sqlite')
+        store = GenderStore(path) if path else None
+        predictions = store.get_many(unique_names) if store else {}
+        missing_names = [name for name in unique_names if name not in predictions]
+        util.info("{} of {} names found in gender store.".format(len(predictions), len(unique_names)))
+        if store: metrics.count_cache('genders', len(predictions), len(missing_names))
+
+        apikey = self.config.gender_apikey
+        request_batch = lambda names, i: namsor_request(names, i, apikey)
+        request_batch_async = lambda session, names, i: namsor_request_async(session, names, i, apikey)
+        for start in range(0, len(missing_names), STORE_CHUNK_SIZE):
+            results = batch_iterate(missing_names[start:start + STORE_CHUNK_SIZE], request_batch, request_batch_async, 
+                                    batch_size=NAMSOR_BATCH_SIZE, max_workers=10, tuples=True)
+            new_predictions = {}
+            for (batch_predictions,) in results:
+                new_predictions.update(batch_predictions)
+            predictions.update(new_predictions)
+            if store: store.add_many(new_predictions)
+
+        if store: 
+            store.count(unique_names)
+            store.close()
+        genders_dict = {name : gender for name, (gender, _) in predictions.items()}
         return genders_dict
     
-    def print_stats(self):
-        number_female_authors = 0
-        number_authors = 0
-        for group in self.genders:
-            for gender in group:
-                number_authors += 1
-                if gender == 'female':
-                    number_female_authors += 1
-        super().print_stats()
+    def print_stats(self, aggregates=None):
+        if aggregates is None: aggregates = self.aggregate()
+        super().print_stats(aggregates)
         print("     Fraction female authors: {}"
-              .format(number_female_authors/number_authors))
+              .format(aggregates['fraction_female']))
+
+    def summary(self, aggregates=None):
+        if aggregates is None: aggregates = self.aggregate()
+        summary = super().summary(aggregates)
+        summary['fraction_female'] = aggregates['fraction_female']
+        return summary
+
+    def csv_frame(self, works, partial=False):
+        """ Returns the works as written to the CSV, with predicted genders after institutions.
+        """
+        df = super().csv_frame(works, partial)
+        if 'genders' in works:
+            df.insert(4, 'predicted gender', works['genders'].map(util.namelist2string))
+        return df
         
-    def display_data(self):
+    def display_data(self, aggregates=None):
         """ Displays visualizations and/or writes data csv as dictated by commandline args.
         """
-        dict = {'author' : self.authors, 
-                'title' : self.titles, 
-                'year' : self.years,
-                'institution' : self.institution_names, 
-                'predicted gender' : self.gender_strings}
-        if self.analysis.abstracts: 
-            dict['abstract'] = self.abstracts
-        if self.analysis.maps:
-            dict['latitude'] = self.latitudes
-            dict['longitude'] = self.longitudes
-
-        df = pd.DataFrame(dict)
-        util.info("Data preview")
-        util.info(df.head())
-
-        util.info("Writing csv...")
-        df.to_csv(self.config.csv)
+        super().display_data(aggregates)
+        self.plot_gender_by_year(aggregates=aggregates)
 
-        self.plot_gender_by_year()
-
-        if self.analysis.maps:
-            util.info("Mapping points...")
-            map_dict = {'latitude' : self.latitudes, 'longitude' : self.longitudes} 
-            map_df = pd.DataFrame(map_dict)
-            df = map_df.groupby(['longitude', 'latitude']).size().reset_index(name='counts')
-            map_points(df, self.config.map)
-            util.info("Map " + self.config.map + " created!")
-
-    def plot_gender_by_year(self, bucket_size=5):
+    @metrics.stage('plot_gender_by_year')
+    def plot_gender_by_year(self, bucket_size=5, aggregates=None):
         """ Given GenderData object, generates line plot of genders of authors over time.
         """
-        gender_dict, year_buckets = {}, [] #genders maps (gender, year) pairs to counts of occurrences
-        for gender_lst, year in zip(self.genders, self.years):
-            bucket = (int(year) // bucket_size) * bucket_size
-            year_buckets.append(bucket)
-            for gender in gender_lst:
-                util.increment((gender, bucket), gender_dict)
-
-        dict = {'year': sorted(list(set(year_buckets))), 
-                'male': [], 
-                'female': []}
-
-        for gender in ['male', 'female']:
-            for year in dict['year']:
-                if (gender, year) in gender_dict:
-                    dict[gender].append(gender_dict[(gender, year)])
-                else:
-                    dict[gender].append(0)     
-
-        df = pd.DataFrame(dict)
-        df.sort_values(by='year', ascending=True)
+        if aggregates is None or bucket_size not in aggregates['gender_by_year']: 
+            aggregates = stats.aggregate(self.works, bucket_sizes=(bucket_size,))
+        df = aggregates['gender_by_year'][bucket_size]
 
+        import matplotlib.pyplot as plt # deferred: only gender runs plot
+        plt.figure() # new figure for each journal
         plt.plot(df['year'], df['female'], marker='o', label='Female', color='red')
         plt.plot(df['year'], df['male'], marker='o', label='Male', color='blue')
 
@@ -140,54 +133,158 @@ class GenderData(Data):
         plt.legend()
         plt.grid(True)
         plt.savefig(self.config.gender_plot)
+        plt.close()
 
-def full2first_names(authors):
+def full2first_names(authors, author_ids=None, alternatives=None):
     """ 
     Given a list of groups of authors, 
-    returns a list of first names found in the authors list and an inverted index indicating the name locations.
+    returns a list of first names found in the authors list and each work's first names, by author.
 
         Args:    
-            authors: list[str] st each str is a semicolon-separated list of one or more full names
+            authors: list[list[str]] of full names of each work's authors
+            author_ids: optional list[list[author ID]] aligned with authors
+            alternatives: optional dict[author short ID : full name] to use for authors listed by initials
         Returns:
-            first_names: list[str] of unique first names (first approximated by first 'word' in each name)
-            inverted_index: dict[name : list[indices]] mapping occurrences of each first name in original list of names
+            first_names: list[str] of normalized first names (see first_name); 
+                         names with only initials and no alternative are left out
+            work_names: list[list[str]] of each work's first names, aligned with authors (None where left out)
+    """
+    first_names, work_names = [], []
+    for i, full_names in enumerate(authors):
+        ids = author_ids[i] if author_ids else []
+        names = []
+        for j, full_name in enumerate(full_names):
+            name = first_name(full_name or '')
+            if not name and alternatives and j < len(ids) and ids[j]:
+                name = first_name(alternatives.get(short_id(ids[j]), ''))
+            if name:
+                first_names.append(name)
+            names.append(name)
+        work_names.append(names)
+    return first_names, work_names
+
+def first_name(full_name):
+    """ 
+    Given a full name, returns its normalized first name: the first word that is not an honorific,
+    casefolded and with diacritics removed ("Dr. JEAN-LUC Picard" -> "jean-luc").
+    Returns None if there is no such word or it is only initials ("J.", "J.-L.").
+    """
+    for word in full_name.split():
+        word = normalize_name(word)
+        if word.strip('.') in HONORIFICS: 
+            continue
+        if is_initials(word): 
+            return None
+        return word.strip('.')
+    return None
+
+def normalize_name(name):
+    """ Casefolds a name and strips diacritics ("Jérôme" -> "jerome").
+    """
+    decomposed = unicodedata.normalize('NFKD', name.casefold())
+    return ''.join(char for char in decomposed if not unicodedata.combining(char))
+
+def is_initials(word):
+    """ True if every hyphen- or period-separated part of the word is a single letter ("j", "j.", "j.-l.")
+    """
+    parts = [part for part in re.split(r'[.\-]', word) if part]
+    return all(len(part) <= 1 for part in parts)
+
+def initialed_author_ids(authors, author_ids):
+    """ Given full names and aligned author IDs of each work's authors, 
+        returns unique short IDs of the authors whose first name is only initials.
     """
-    separator = ';'
-    first_names, inverted_index = [], {}
-    for i, author_group in enumerate(authors):
-        full_names = author_group.split(separator)
-        for name in full_names:
-            try: 
-                first_name = name.split()[0]
-                first_names.append(first_name)
-                util.add_to_inverted_index(first_name, i, inverted_index)
-            except: 
-                pass
-    return first_names, inverted_index
-
-def namsor_request(apikey_and_names, i):
+    initialed = []
+    for full_names, ids in zip(authors, author_ids):
+        for full_name, id in zip(full_names, ids):
+            if id and not first_name(full_name or ''):
+                initialed.append(short_id(id))
+    return util.unique(initialed)
+
+def alternative_names(ids, email=None):
+    """ Given short IDs of Authors, returns a dict of ID -> the first of their OpenAlex 
+        display name and alternative name forms whose first name is not only initials.
+    """
+    if not ids: return {}
+    request_batch = lambda id_batch, i: alternative_names_batch(id_batch, i, email)
+    request_batch_async = lambda session, id_batch, i: alternative_names_batch_async(session, id_batch, i, email)
+    results = batch_iterate(ids, request_batch, request_batch_async, batch_size=OPENALEX_IDS_PER_REQUEST, 
+                            max_workers=8, tuples=True)
+    alternatives = {}
+    for (batch_alternatives,) in results:
+        alternatives.update(batch_alternatives)
+    return alternatives
+
+def alternative_names_batch(ids, i, email=None):
+    """ 
+        NOTE: Target function for multithreading
+        Given a batch of at most 50 Author IDs, returns their full name alternatives from one OpenAlex request.
+    """
+    response = api_get(author_names_url(ids, email))
+    return parse_author_names(response), i
+
+async def alternative_names_batch_async(session, ids, i, email=None):
+    """ NOTE: Target function for the async engine - see alternative_names_batch
+    """
+    response = await api_get_async(session, author_names_url(ids, email))
+    return parse_author_names(response), i
+
+def author_names_url(ids, email=None):
+    url = (multiRequests.OPENALEX_API + "/authors?filter=ids.openalex:" + '|'.join(ids) + 
+           "&select=id,display_name,display_name_alternatives&per_page=" + str(OPENALEX_IDS_PER_REQUEST))
+    if email: url += '&mailto=' + email
+    return url
+
+def parse_author_names(response):
+    alternatives = {}
+    if not response: return alternatives
+    for author in response['results']:
+        names = [author['display_name']] + (author.get('display_name_alternatives') or [])
+        full_names = [name for name in names if name and first_name(name)]
+        if full_names:
+            alternatives[short_id(author['id'])] = full_names[0]
+    return alternatives
+
+def namsor_request(name_list, i, apikey):
     """ 
-    Given a batch list of first names, returns the list of corresponding genders and the batch index. 
+    Given a batch list of first names, returns their predicted genders and the batch index. 
     (Via Namsor genderguesser API.)
         Args: 
-            apikey_and_names: tuple(str, [str]) apikey for Namsor pulled from config file 
-                                                and list of first names for which to predict genders
+            name_list: list of at most 100 first names for which to predict genders
             i: int index of batch in larger list
+            apikey: str apikey for Namsor pulled from config file 
         Returns: 
-            list of predicted genders and batch index
+            dict of name -> (predicted gender, probability) and batch index
+    """
+    url, payload, headers = namsor_query(apikey, name_list)
+    response = api_post(url, payload=payload, headers=headers)
+    return parse_namsor(response, name_list), i
+
+async def namsor_request_async(session, name_list, i, apikey):
+    """ NOTE: Target function for the async engine - see namsor_request
     """
-    #print(apikey_and_names)
-    apikey, name_list = apikey_and_names
-    url = "https://v2.namsor.com/NamSorAPIv2/api2/json/genderBatch"
+    url, payload, headers = namsor_query(apikey, name_list)
+    response = await api_post_async(session, url, payload=payload, headers=headers)
+    return parse_namsor(response, name_list), i
+
+def parse_namsor(response, name_list):
+    """ Given a genderBatch response and the list of names requested, 
+        returns dict of name -> (predicted gender, probability)
+    """
+    if not response: return {} # error occurred decoding Response
+    return {name_list[int(prediction['id'])] : (prediction['likelyGender'], prediction.get('probabilityCalibrated'))
+            for prediction in response['personalNames']}
+
+def namsor_query(apikey, name_list):
+    """ Given a Namsor API key and list of first names, returns the url, payload and headers
+        of the genderBatch request for them.
+    """
+    url = multiRequests.NAMSOR_API + "/genderBatch"
     name_queries = [{"id": id, "firstName": name} for id, name in enumerate(name_list)]
     payload = {"personalNames": name_queries}
-    headers = headers = {
+    headers = {
         "X-API-KEY": apikey,
         "Accept": "application/json",
         "Content-Type": "application/json"
     }
-
-    response = api_post(url, payload=payload, headers=headers)
-    if not response: return [] # error occurred decoding Response
-    genders = [(prediction['likelyGender']) for prediction in response['personalNames']]
-    return genders, i
\ No newline at end of file
+    return url, payload, headers
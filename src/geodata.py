@@ -1,93 +1,283 @@
 import numpy as np
-import pygmt as pgm
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 import util
-from multiRequests import api_get
+import metrics
+import multiRequests
+from multiRequests import api_get, api_get_async, batch_iterate
+from cache import STORE_CHUNK_SIZE
 
 
-def parse_work_geodata(institutions_and_authors, i):
+OPENALEX_IDS_PER_REQUEST = 50 # maximum number of IDs OpenAlex accepts in one OR filter
+MAP_REGION = [-180, 180, -60, 80] # west, east, south, north
+MAP_PROJECTION = "M8i"
+MAP_WORKERS = 4 # processes rendering a map series
+
+def resolve_geodata(institution_id_batches, author_id_batches, email=None, max_workers=8, store=None):
+    """ Given, for each work, lists of institution IDs and author IDs, 
+        returns a latitude and longitude for each work. 
+        Unique institutions and authors across all works are resolved with 
+        multi-ID requests, so the request count scales with the number of distinct entities.
+        Args:
+            institution_id_batches: list[list[institution ID]] - for each work
+            author_id_batches: list[list[author ID]] - for each work
+            email: str reply-to email for OpenAlex API calls
+            max_workers: int number of threads to dispatch requests
+            store: optional cache.GeodataStore consulted before requesting institutions
+        Returns:
+            list[(float, float, str)] - latitude, longitude and country code for each work: of the first 
+            institution with geodata if found, else of the first author's last known institution with geodata
+    """
+    institutions = util.unique([short_id(id) for ids in institution_id_batches for id in ids if id])
+    geodata = institutions_geodata(institutions, email, max_workers, store)
+
+    # fall back on authors only for works with no located institution
+    unlocated = [not any(has_geodata(geodata, short_id(id)) for id in ids if id) for ids in institution_id_batches]
+    authors = util.unique([short_id(id) for ids, missing in zip(author_id_batches, unlocated) 
+                                        if missing for id in ids if id])
+    last_institutions = authors_last_institution(authors, email, max_workers, store)
+    new_institutions = util.unique([id for id in last_institutions.values() if id and id not in geodata])
+    geodata.update(institutions_geodata(new_institutions, email, max_workers, store))
+
+    coordinates = []
+    for institution_ids, author_ids in zip(institution_id_batches, author_id_batches):
+        candidates = [short_id(id) for id in institution_ids if id] + \
+                     [last_institutions.get(short_id(id)) for id in author_ids if id]
+        located = [id for id in candidates if has_geodata(geodata, id)]
+        if located: 
+            coordinates.append(geodata[located[0]])
+        else:                   # none of the institutions or authors had geodata
+            coordinates.append((np.nan, np.nan, None))
+    return coordinates
+
+def short_id(id):
+    """ Given an OpenAlex ID as a full url (https://openalex.org/I123) or short ID (I123), 
+        returns the short ID. 
+    """
+    return id.rsplit('/', 1)[-1]
+
+def has_geodata(geodata, id):
+    return id in geodata and not np.isnan(geodata[id][0])
+
+def institutions_geodata(ids, email=None, max_workers=8, store=None):
+    """ Given a list of unique Institution IDs, returns a dict of each ID mapped to 
+        (latitude, longitude, country code), with NaN coordinates when OpenAlex has no geodata.
+        If a store is given, only IDs missing from it are requested, and the results are saved to it
+        every STORE_CHUNK_SIZE IDs. IDs whose request failed get NaN coordinates but are not stored,
+        so they are requested again by the next run.
+    """
+    if not ids: return {}
+    geodata = {id : (np.nan, np.nan, None) for id in ids}
+    if not store:
+        geodata.update(request_institutions(ids, email, max_workers))
+        return geodata
+    stored = store.get_many(ids)
+    missing = [id for id in ids if id not in stored]
+    util.info("{} of {} institutions found in geodata store.".format(len(stored), len(ids)))
+    metrics.count_cache('geodata', len(stored), len(missing))
+    geodata.update(stored)
+    for start in range(0, len(missing), STORE_CHUNK_SIZE):
+        requested = request_institutions(missing[start:start + STORE_CHUNK_SIZE], email, max_workers)
+        store.put_many(requested)
+        geodata.update(requested)
+    return geodata
+
+def request_institutions(ids, email=None, max_workers=8):
+    """ Given a list of unique Institution IDs, requests them in batches and returns a dict of ID -> 
+        (latitude, longitude, country code) for every ID OpenAlex answered for, with NaN coordinates 
+        when it has no geodata. IDs in failed requests are left out.
+    """
+    request_batch = lambda id_batch, i: institutions_geodata_batch(id_batch, i, email)
+    request_batch_async = lambda session, id_batch, i: institutions_geodata_batch_async(session, id_batch, i, email)
+    results = batch_iterate(ids, request_batch, request_batch_async, batch_size=OPENALEX_IDS_PER_REQUEST, 
+                            max_workers=max_workers, tuples=True)
+    geodata = {}
+    for (batch_geodata,) in results:
+        geodata.update(batch_geodata)
+    return geodata
+
+def institutions_geodata_batch(ids, i, email=None):
     """ 
-        NOTE: Target function for multiprocessing
-        Given list of institution IDs and author IDs, 
-        returns a list of latitudes and longitudes for those authors
+        NOTE: Target function for multithreading
+        Given a batch of at most 50 Institution IDs, returns their geodata from one OpenAlex request.
         Args:
-            institution_and_authors: list[tuple(institution_id, author_id)] 
+            ids: list[str] short IDs of Institutions
             i : int - batch index.
         Returns: 
-            latitude, longitude, i for the institution if found, else author's last known insitution
+            dict of ID -> (latitude, longitude, country code) for each ID (see parse_institutions), i
+    """
+    response = api_get(institutions_url(ids, email))
+    return parse_institutions(response, ids), i
+
+async def institutions_geodata_batch_async(session, ids, i, email=None):
+    """ NOTE: Target function for the async engine - see institutions_geodata_batch
+    """
+    response = await api_get_async(session, institutions_url(ids, email))
+    return parse_institutions(response, ids), i
+
+def institutions_url(ids, email=None):
+    url = (multiRequests.OPENALEX_API + "/institutions?filter=ids.openalex:" + '|'.join(ids) + 
+           "&select=id,geo&per_page=" + str(OPENALEX_IDS_PER_REQUEST))
+    if email: url += '&mailto=' + email
+    return url
+
+def parse_institutions(response, ids):
+    """ Given the OpenAlex response to a request for the Institutions with the given IDs, 
+        returns dict of ID -> (latitude, longitude, country code) for each ID, NaN coordinates if without geodata.
+        Returns an empty dict if the request failed (response is None).
+    """
+    if not response: return {}
+    geodata = {id : (np.nan, np.nan, None) for id in ids}
+    for institution in response['results']:
+        geo = institution['geo'] or {}
+        if geo.get('latitude') is not None:
+            geodata[short_id(institution['id'])] = (geo['latitude'], geo['longitude'], geo.get('country_code'))
+    return geodata
+
+def authors_last_institution(ids, email=None, max_workers=8, store=None):
+    """ Given a list of unique Author IDs, returns a dict of each ID mapped to 
+        the short ID of their last known institution (None if unknown).
+        If a store is given, it is used as in institutions_geodata.
+    """
+    if not ids: return {}
+    last_institutions = {id : None for id in ids}
+    if not store:
+        last_institutions.update(request_authors(ids, email, max_workers))
+        return last_institutions
+    stored = store.get_authors(ids)
+    missing = [id for id in ids if id not in stored]
+    util.info("{} of {} authors found in geodata store.".format(len(stored), len(ids)))
+    metrics.count_cache('authors', len(stored), len(missing))
+    last_institutions.update(stored)
+    for start in range(0, len(missing), STORE_CHUNK_SIZE):
+        requested = request_authors(missing[start:start + STORE_CHUNK_SIZE], email, max_workers)
+        store.put_authors(requested)
+        last_institutions.update(requested)
+    return last_institutions
+
+def request_authors(ids, email=None, max_workers=8):
+    """ Given a list of unique Author IDs, requests them in batches and returns a dict of ID -> 
+        last known Institution short ID (None if unknown) for every ID OpenAlex answered for. 
+        IDs in failed requests are left out.
+    """
+    request_batch = lambda id_batch, i: authors_last_institution_batch(id_batch, i, email)
+    request_batch_async = lambda session, id_batch, i: authors_last_institution_batch_async(session, id_batch, i, email)
+    results = batch_iterate(ids, request_batch, request_batch_async, batch_size=OPENALEX_IDS_PER_REQUEST, 
+                            max_workers=max_workers, tuples=True)
+    last_institutions = {}
+    for (batch_institutions,) in results:
+        last_institutions.update(batch_institutions)
+    return last_institutions
+
+def authors_last_institution_batch(ids, i, email=None):
     """ 
-    institution_batch, author_batch = institutions_and_authors[0]
-    latitude, longitude = np.nan, np.nan
-    for institution in institution_batch:
-        latitude, longitude = institution_id_geodata(institution)
-        if latitude != np.nan: 
-            return latitude, longitude, i
-    for author in author_batch:
-        latitude, longitude = author_id_geodata(author)
-        if latitude != np.nan: 
-            return latitude, longitude, i
-    return latitude, longitude, i         # none of the institutions or authors had geodata
+        NOTE: Target function for multithreading
+        Given a batch of at most 50 Author IDs, returns their last known institutions from one OpenAlex request.
+        Args:
+            ids: list[str] short IDs of Authors
+            i : int - batch index.
+        Returns: 
+            dict of author ID -> institution ID (or None) for each ID (see parse_authors), i
+    """
+    response = api_get(authors_url(ids, email))
+    return parse_authors(response, ids), i
+
+async def authors_last_institution_batch_async(session, ids, i, email=None):
+    """ NOTE: Target function for the async engine - see authors_last_institution_batch
+    """
+    response = await api_get_async(session, authors_url(ids, email))
+    return parse_authors(response, ids), i
+
+def authors_url(ids, email=None):
+    url = (multiRequests.OPENALEX_API + "/authors?filter=ids.openalex:" + '|'.join(ids) + 
+           "&select=id,last_known_institutions&per_page=" + str(OPENALEX_IDS_PER_REQUEST))
+    if email: url += '&mailto=' + email
+    return url
+
+def parse_authors(response, ids):
+    """ Given the OpenAlex response to a request for the Authors with the given IDs, 
+        returns dict of author ID -> last known institution ID for each ID, None if unknown.
+        Returns an empty dict if the request failed (response is None).
+    """
+    if not response: return {}
+    last_institutions = {id : None for id in ids}
+    for author in response['results']:
+        if author['last_known_institutions']:
+            last_institutions[short_id(author['id'])] = short_id(author['last_known_institutions'][0]['id'])
+    return last_institutions
         
-def institution_id_geodata(id):
+def institution_id_geodata(id, email=None, store=None):
     """ Given an Institution ID, returns latitudes and longitudes of institution
         Args:
             id: string ID of Institution to check for geodata
+            store: optional cache.GeodataStore to check first
         Returns
             (float, float) - latitude and longitude of institution
     """
-    lat, long = np.nan, np.nan
-    if not id: return lat, long
-
-    url =  "https://api.openalex.org/institutions/" + id
-    institution = api_get(url)
-    if not institution: return lat, long
-
-    if 'latitude' in institution['geo']:
-        lat = institution['geo']['latitude']
-        long = institution['geo']['longitude']
+    if not id: return np.nan, np.nan
+    lat, long, _ = institutions_geodata([short_id(id)], email, store=store)[short_id(id)]
     return lat, long
         
-def author_id_geodata(id):
+def author_id_geodata(id, email=None, store=None):
     """ Given an author ID, returns the latitude and longitude of their last known institution
         Args:
             id: string ID of Author to check for geodata (most recent institution)
+            store: optional cache.GeodataStore to check for the institution first
         Returns: 
             (float, float) - latitude and longitude of author's most recent institution
     """
-    lat, long = np.nan, np.nan
-    if not id: return lat, long
+    if not id: return np.nan, np.nan
+    institution_id = authors_last_institution([short_id(id)], email, store=store)[short_id(id)]
+    return institution_id_geodata(institution_id, email, store)
 
-    url =  "https://api.openalex.org/authors/" + id
-    author = api_get(url)
-    if not author: return lat, long
-    if author['last_known_institutions']:
-        if len(author['last_known_institutions']) > 0: 
-            institution_id = author['last_known_institutions'][0]['id']
-            lat, long = institution_id_geodata(institution_id)
-    return lat, long
+def grid_points(latitudes, longitudes, cell_size=None):
+    """ Given the latitude and longitude of each work, returns a df of distinct points with 
+        latitude, longitude, and counts (works at each point). Works without geodata are left out.
+        Args:
+            latitudes, longitudes: array-likes of float coordinates, NaN where unknown
+            cell_size: optional float grid cell size in degrees; points are snapped to the center 
+                       of their cell, so nearby institutions are drawn as one larger point
+        Returns:
+            pd.DataFrame with columns latitude, longitude, counts
+    """
+    latitudes = np.asarray(latitudes, dtype=float)
+    longitudes = np.asarray(longitudes, dtype=float)
+    located = ~(np.isnan(latitudes) | np.isnan(longitudes))
+    latitudes, longitudes = latitudes[located], longitudes[located]
+    if cell_size:
+        latitudes = (np.floor(latitudes / cell_size) + 0.5) * cell_size
+        longitudes = (np.floor(longitudes / cell_size) + 0.5) * cell_size
+    points, counts = np.unique(np.column_stack((longitudes, latitudes)), axis=0, return_counts=True)
+    return pd.DataFrame({'latitude' : points[:, 1], 'longitude' : points[:, 0], 'counts' : counts})
 
-def map_points(df, path): 
-    """ Given a df with latitude, longitude, and counts, generating a map plotting the locations 
-        to file specified by config
+def map_points(df, path, region=MAP_REGION, projection=MAP_PROJECTION, title=None): 
+    """ Given a df with latitude, longitude, and counts, plots the locations (sized by count) 
+        on a map saved to path.
     """
-    region = [-180, 180,
-                -60, 80,]
-    fig = pgm.Figure()
-    fig.basemap(region=region, projection="M8i", frame=True)
-    fig.coast(land="black", water="skyblue")
-    fig.plot(x=df.longitude, y=df.latitude, style="c0.3c", fill="black", pen="black")
- 
+    import pygmt as pgm # loads the GMT library, so only imported once a map is drawn
     fig = pgm.Figure()
-    fig.basemap(region=region, projection="M8i", frame=True)
+    fig.basemap(region=region, projection=projection, frame=['af', '+t' + title] if title else True)
     fig.coast(land="lightblue", water="white")
-    #fig.coast(land="sage?", water="white")
-    fig.plot(
-        x=df.longitude,
-        y=df.latitude,
-        size=0.08 + 0.04*(np.log2(df.counts)),
-        style="cc",
-        fill='black',
-        #fill="darkblue",
-        #fill="gray40",
-        transparency=60
-    )
-    fig.savefig(path)
\ No newline at end of file
+    if len(df):
+        fig.plot(
+            x=df.longitude,
+            y=df.latitude,
+            size=0.08 + 0.04*(np.log2(df.counts)),
+            style="cc",
+            fill='black',
+            transparency=60
+        )
+    fig.savefig(path)
+    return path
+
+def map_series(maps, max_workers=MAP_WORKERS):
+    """ Given a list of map_points argument tuples (df, path[, region, projection, title]), 
+        renders every map, in parallel worker processes when there is more than one.
+        Returns:
+            list[str] paths of the maps written
+    """
+    if len(maps) <= 1:
+        return [map_points(*args) for args in maps]
+    with ProcessPoolExecutor(max_workers=min(max_workers, len(maps))) as executor:
+        futures = [executor.submit(map_points, *args) for args in maps]
+        return [future.result() for future in futures]
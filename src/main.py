@@ -1,16 +1,26 @@
-import os
 import sys
+import copy
 import argparse
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 import util
-from dataClass import Data
+import snapshot
+import multiRequests
+import metrics
+from dataclass import Data
 from genderClass import GenderData
 
+BATCH_WORKERS = 4 # journals crawled at once with --batch
+
 def parseArguments():
     parser = argparse.ArgumentParser()
     #parser.add_argument("email", help="the reply-to email for OpenAlex API calls") # required=True,
     parser.add_argument("config_path", help="path to the config file")
 
-    parser.add_argument("journal_name", help="name of journal or source to search for")
+    parser.add_argument("journal_name", nargs="?", help="name of journal or source to search for")
+
+    parser.add_argument("-b", "--batch", dest="batch", default=None, 
+        help="path to a file listing journals (one per line) to analyze together instead of journal_name")
     
     parser.add_argument("-s", "--sample", dest="sample_size", 
         type=int, default=None, help="include sample size (max of 10,000) to analyze subset")
@@ -20,64 +30,274 @@ def parseArguments():
     parser.add_argument("-a", "--write_abstracts", dest="abstracts", 
         action="store_true", help="include to write abstracts of all works to csv") 
 
+    parser.add_argument("--lazy_abstracts", dest="lazy_abstracts", action="store_true", 
+        help="with -a, keep abstracts as inverted indexes while crawling and decode them once when the data is saved. " +
+             "The partial csv written while crawling has no abstracts") 
+
     parser.add_argument("-g", "--predict_gender", dest="gender", 
         action="store_true", help="include to predict genders of all authors and write to csv") 
 
     parser.add_argument("-m", "--write_maps", dest="maps", 
         action="store_true", help="include to plot locations of affiliated institutions") 
 
+    parser.add_argument("-c", "--countries", dest="countries", action="store_true", 
+        help="include to count works per author country, from the crawled works alone (no extra requests)")
+
+    parser.add_argument("--map_decades", dest="map_decades", action="store_true", 
+                        help="with -m, also write a map of each decade's works")
+
     parser.add_argument("-r", "--restore_saved", action="store_true", help="include to restore saved data") 
 
+    parser.add_argument("-u", "--update", action="store_true", 
+        help="include to update saved data with only the works created or updated since it was saved") 
+
+    parser.add_argument("--resume", action="store_true", 
+        help="include to continue an interrupted run from its checkpoint, without requesting saved pages again")
+
+    parser.add_argument("--stats_only", action="store_true", 
+        help="include to only print summary statistics (works per year, top institutions and, with -c, countries), " +
+             "counted by OpenAlex without crawling every work. Ignored with -g, -a or -m, which need every work")
+
     parser.add_argument("--start_year", dest="start_year", type=int, default=None, 
                         help="filter publication dates by this earliest year (inclusive)")
     
     parser.add_argument("--end_year", dest="end_year", type=int, default=None, 
                         help="filter publication dates by this latest year (inclusive)")
 
+    parser.add_argument("--prefetch", dest="prefetch", type=int, default=2, 
+                        help="number of pages of works to request ahead while parsing (default 2)")
+
+    parser.add_argument("--shards", dest="shards", type=int, default=1, 
+                        help="number of publication year ranges to crawl concurrently (default 1)")
+
+    parser.add_argument("--engine", dest="engine", choices=["threads", "async"], default="threads", 
+                        help="run batched geodata and gender requests on threads or on asyncio (requires aiohttp)")
+
+    parser.add_argument("--profile", dest="profile", default=None, 
+                        help="path to write a JSON report of stage timings, HTTP requests, cache hits and peak memory")
+
+    parser.add_argument("--trace", dest="trace", default=None, 
+                        help="path to write the stage timings as a Chrome trace (chrome://tracing)")
+
     args = parser.parse_args()
+    if not args.journal_name and not args.batch:
+        parser.error("either journal_name or --batch is required")
 
     if args.verbose: 
         util.VERBOSE = True
+    multiRequests.ENGINE = args.engine
     return args
 
-def restore_saved(path):
-    util.info("Restoring saved data.")
-    cached_data = util.unpickle_data(path)
+def load_saved_metadata(data, path):
+    """ Given a Data object and the path to a snapshot, returns the snapshot's metadata 
+        after checking it is of the same journal and has the columns needed for the requested outputs.
+    """
+    metadata = snapshot.load_metadata(path)
     util.info(
     "     Journal: {}\n \
     Sample size: {}\n \
     Start year: {}\n \
-    End year: {}\n "
-        .format(cached_data.analysis.journal_name,
-        cached_data.analysis.sample_size,
-        cached_data.analysis.start_year,
-        cached_data.analysis.end_year))
-    return cached_data
+    End year: {}\n \
+    Saved at: {}\n "
+        .format(metadata['journal_name'],
+        metadata['sample_size'],
+        metadata['start_year'],
+        metadata['end_year'],
+        metadata['saved_at']))
+    if metadata['source_id'] != data.source_id:
+        raise Exception("Searched source ID does not match saved ID. \
+                        Check config file to confirm journal data source.")
+    missing = [column for column in data.snapshot_columns() if column not in metadata['columns']]
+    if missing:
+        raise Exception("Saved data has no " + ', '.join(missing) + " columns. " + 
+                        "Rerun without -r or -u to collect them.")
+    return metadata
+
+@metrics.stage('restore_saved')
+def restore_saved(data, path):
+    """ Given a Data object and the path to a snapshot of the same journal, 
+        loads the saved works, reading only the columns needed for the requested outputs.
+    """
+    util.info("Restoring saved data.")
+    load_saved_metadata(data, path)
+    data.works = snapshot.load_works(path, columns=data.snapshot_columns())
+
+def update_search(data, path):
+    """ Given a Data object and the path to a snapshot of the same journal,
+        requests only works created or updated since the snapshot was saved. 
+        Returns the saved works, to merge the new works into once they have additional data.
+    """
+    util.info("Updating saved data.")
+    if data.analysis.sample_size:
+        raise Exception("Saved data cannot be updated for a sample. Rerun without -s.")
+    if not data.config.openalex_apikey:
+        raise Exception("Updating saved data filters works by from_updated_date, which OpenAlex only allows " + 
+                        "with a premium API key. Add it to the config file as openalex_key, or rerun without -u.")
+    metadata = load_saved_metadata(data, path)
+    if (metadata['start_year'], metadata['end_year']) != (data.analysis.start_year, data.analysis.end_year):
+        raise Exception("Saved data covers years {} to {}, not the requested range. ".format(
+                        metadata['start_year'], metadata['end_year']) + 
+                        "Rerun -u with the same --start_year and --end_year, or without -u.")
+    saved_works = snapshot.load_works(path)
+    data.updated_since = metadata['saved_at'][:10] # same-day works are requested again and replaced
+    data.iterate_search()
+    return saved_works
+
+def new_data(args, config_json, journal_name):
+    """ Returns a Data (or GenderData, with -g) object for the named journal. 
+    """
+    args = copy.copy(args) # Data records the journal's display name on its own args
+    args.journal_name = journal_name
+    if args.gender: 
+        return GenderData(args, config_json)
+    return Data(args, config_json)
+
+def collect_works(data, args):
+    """ Fills data.works by restoring saved data (-r), by requesting works updated since it was saved (-u),
+        or by iterating through all of the journal's works.
+        Returns:
+            (bool, DataFrame) - whether the works were requested and still need additional data,
+            and the saved works to merge them into (None unless updating)
+    """
+    path = data.config.data_src
+    if args.restore_saved and snapshot.exists(path):
+        restore_saved(data, path)
+        return False, None
+    if args.update and snapshot.exists(path):
+        return True, update_search(data, path)
+    util.info("Iterating through journal works...")
+    data.iterate_search()
+    return True, None
+
+@metrics.stage('save_works')
+def save_works(data, saved_works=None):
+    """ Merges newly requested works into saved works if updating, and saves the journal's snapshot.
+    """
+    if saved_works is not None:
+        data.upsert_works(saved_works)
+    snapshot.save_snapshot(data, dst=data.config.data_dst)
+    util.info("Saved data to " + data.config.data_dst + ".") 
+    if data.checkpoint: # the snapshot now holds everything the checkpoint did
+        data.checkpoint.clear()
+
+def populate_shared(datas):
+    """ Given Data objects of the same class for several journals, populates all of their works with 
+        additional data in one pass, so authors, names and institutions shared between journals 
+        are only resolved once.
+    """
+    for data in datas: 
+        if not len(data.works): # nothing to resolve, but the columns are still added
+            data.populate_additional_data()
+    datas = [data for data in datas if len(data.works)]
+    if not datas: return
+    resolver = copy.copy(datas[0])
+    resolver.works = pd.concat([data.works for data in datas], ignore_index=True)
+    resolver.populate_additional_data()
+    start = 0
+    for data in datas:
+        end = start + len(data.works)
+        data.works = resolver.works.iloc[start:end].reset_index(drop=True)
+        start = end
+
+def write_comparison(datas, aggregates, path):
+    """ Given Data objects for several journals and their aggregates, 
+        writes a CSV with one row of summary statistics per journal.
+    """
+    df = pd.DataFrame([data.summary(data_aggregates) for data, data_aggregates in zip(datas, aggregates)])
+    util.info(df)
+    df.to_csv(path, index=False)
+    util.info("Comparison table written to " + path + ".")
 
 def main(args):
+    try:
+        with metrics.stage('main'):
+            if args.batch:
+                main_batch(args)
+            else:
+                main_single(args)
+    finally: # also reports runs that stopped early
+        if args.profile:
+            metrics.write_report(args.profile)
+            util.info("Profile written to " + args.profile + ".")
+        if args.trace:
+            metrics.write_trace(args.trace)
+            util.info("Trace written to " + args.trace + ".")
+
+def stats_only(args):
+    """ True if --stats_only was given and all requested outputs can be counted by OpenAlex (group_by):
+        per-work and per-author analyses (-g, -a, -m) fall back to the full crawl.
+    """
+    if not args.stats_only: return False
+    if args.gender or args.abstracts or args.maps:
+        util.info("Running the full crawl: -g, -a and -m need every work, so --stats_only is ignored.")
+        return False
+    return True
+
+def show_group_stats(data, aggregates):
+    """ Prints the journal's group_by summary statistics (see Data.group_aggregate), 
+        and with -c writes its country table.
+    """
+    if data.analysis.countries:
+        data.write_countries(aggregates)
+    data.print_stats(aggregates)
+
+def main_single(args):
+    """ Analyzes the journal named on the commandline.
+    """
     config_json = util.load_config(args.config_path)
-    if args.gender: 
-        data = GenderData(args, config_json)
-    else: 
-        data = Data(args, config_json)
-
-    if args.restore_saved and os.path.exists(data.config.data_src):
-        cached_data = restore_saved(data.config.data_src)
-        if cached_data.source_id != data.source_id:
-            raise Exception("Searched source ID does not match saved ID. \
-                            Check config file to confirm journal data source.")
-        data = cached_data
-    else: 
-        util.info("Iterating through journal works...")
-        institution_ids, author_ids = data.iterate_search()
-        data.populate_additional_data(institution_ids, author_ids)
-        util.pickle_data(data, dst=data.config.data_dst)
-        util.info("Saved pickled data to " + data.config.data_dst + ".") 
-    data.display_data()
-    data.print_stats()
+    data = new_data(args, config_json, args.journal_name)
+    if stats_only(args):
+        show_group_stats(data, data.group_aggregate())
+        print()
+        return
+
+    crawled, saved_works = collect_works(data, args)
+    if crawled:
+        data.populate_additional_data()
+        save_works(data, saved_works)
+    aggregates = data.aggregate()
+    data.display_data(aggregates)
+    data.print_stats(aggregates)
+    print()
+
+def main_batch(args):
+    """ Analyzes every journal listed in the --batch file. Journals are crawled concurrently under the 
+        shared per-host rate limits and connection pools; their geodata and genders are then resolved 
+        together. Each journal gets its own outputs (paths suffixed with the journal name), 
+        plus one comparison table across journals.
+    """
+    config_json = util.load_config(args.config_path)
+    with open(args.batch, "r") as f:
+        journal_names = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    if not journal_names:
+        util.info("No journals listed in " + args.batch + ".")
+        return
+
+    with ThreadPoolExecutor(max_workers=min(BATCH_WORKERS, len(journal_names))) as executor:
+        datas = list(executor.map(lambda name: new_data(args, config_json, name), journal_names))
+        for data, name in zip(datas, journal_names):
+            data.config = data.config.for_journal(name)
+        if stats_only(args):
+            aggregates = list(executor.map(lambda data: data.group_aggregate(), datas))
+            for data, data_aggregates in zip(datas, aggregates):
+                show_group_stats(data, data_aggregates)
+            write_comparison(datas, aggregates, datas[0].config.comparison)
+            print()
+            return
+        collected = list(executor.map(lambda data: collect_works(data, args), datas))
+
+    populate_shared([data for data, (crawled, _) in zip(datas, collected) if crawled])
+    for data, (crawled, saved_works) in zip(datas, collected):
+        if crawled: 
+            save_works(data, saved_works)
+
+    aggregates = [data.aggregate() for data in datas]
+    for data, data_aggregates in zip(datas, aggregates):
+        data.display_data(data_aggregates)
+        data.print_stats(data_aggregates)
+    write_comparison(datas, aggregates, datas[0].config.comparison)
     print()
     
 if __name__ == "__main__":
     args = parseArguments()
     main(args)
-
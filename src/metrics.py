@@ -0,0 +1,100 @@
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+try:
+    import resource
+except ImportError: # not available on Windows: peak RSS is left out of the report
+    resource = None
+
+# collected for the whole run, reported with --profile
+_lock = threading.Lock()
+_start = time.perf_counter()
+_stages = {}    # name -> {'calls', 'wall_s', 'cpu_s'}
+_events = []    # Chrome trace events, one per finished stage
+_hosts = {}     # host -> {'requests', 'retries', 'throttled', 'errors', 'bytes'}
+_caches = {}    # name -> {'hits', 'misses'}
+
+@contextmanager
+def stage(name):
+    """ Times a pipeline stage (wall and process CPU time), as a context manager or a decorator:
+            with metrics.stage('write_data'): ...
+            @metrics.stage('iterate_search')
+        Stages may nest and run on several threads; each call is one event in the trace.
+    """
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+        with _lock:
+            totals = _stages.setdefault(name, {'calls' : 0, 'wall_s' : 0.0, 'cpu_s' : 0.0})
+            totals['calls'] += 1
+            totals['wall_s'] += wall
+            totals['cpu_s'] += cpu
+            _events.append({'name' : name, 'cat' : 'stage', 'ph' : 'X',
+                            'ts' : (wall_start - _start) * 1e6, 'dur' : wall * 1e6,
+                            'pid' : os.getpid(), 'tid' : threading.get_ident(), 'args' : {'cpu_s' : cpu}})
+
+def count_request(host, status=None, size=0, retried=False):
+    """ Counts one HTTP request to host: its status (None if the connection failed),
+        the bytes downloaded, and whether it is retried. 429 responses are counted as throttled, 
+        and failures that are not retried as errors.
+    """
+    with _lock:
+        counts = _hosts.setdefault(host, {'requests' : 0, 'retries' : 0, 'throttled' : 0,
+                                          'errors' : 0, 'bytes' : 0})
+        counts['requests'] += 1
+        counts['retries'] += retried
+        counts['throttled'] += status == 429
+        counts['errors'] += not retried and (status is None or status >= 400) # failed for good
+        counts['bytes'] += size
+
+def count_cache(name, hits, misses):
+    """ Counts lookups in the named cache (e.g. 'geodata', 'genders').
+    """
+    with _lock:
+        counts = _caches.setdefault(name, {'hits' : 0, 'misses' : 0})
+        counts['hits'] += hits
+        counts['misses'] += misses
+
+def peak_rss_mb():
+    """ Returns the peak resident memory of the process in MB, or None if unknown.
+    """
+    if resource is None: return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10 # bytes on macOS, KB on Linux
+
+def report():
+    """ Returns the metrics collected so far as a JSON-serializable dict.
+    """
+    with _lock:
+        caches = {name : dict(counts, hit_rate=counts['hits'] / (counts['hits'] + counts['misses'])
+                                              if counts['hits'] + counts['misses'] else None)
+                  for name, counts in _caches.items()}
+        return {'generated_at' : datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                'argv' : sys.argv[1:],
+                'wall_s' : time.perf_counter() - _start,
+                'cpu_s' : time.process_time(),
+                'peak_rss_mb' : peak_rss_mb(),
+                'stages' : {name : dict(totals) for name, totals in _stages.items()},
+                'http' : {host : dict(counts) for host, counts in _hosts.items()},
+                'caches' : caches}
+
+def write_report(path):
+    """ Writes the metrics report (see report) as JSON to path.
+    """
+    with open(path, 'w') as f:
+        json.dump(report(), f, indent=2)
+
+def write_trace(path):
+    """ Writes the timed stages in Chrome trace format (open with chrome://tracing or Perfetto).
+    """
+    with _lock:
+        events = list(_events)
+    with open(path, 'w') as f:
+        json.dump({'traceEvents' : events, 'displayTimeUnit' : 'ms'}, f)
@@ -1,10 +1,162 @@
 from util import info
+import metrics
+import asyncio
 import requests
+from requests.adapters import HTTPAdapter
 import time
-import pandas as pd 
+import random
 from tqdm import tqdm
 import itertools
-from concurrent.futures import ThreadPoolExecutor, wait
+import re
+import queue
+import threading
+from urllib.parse import urlparse
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+try:
+    import aiohttp
+except ImportError: # optional: only needed for --engine async
+    aiohttp = None
+
+ENGINE = 'threads'          # or 'async', set by --engine
+ASYNC_CONCURRENCY = 1000    # batches in flight at once on the async engine
+EXECUTOR_WORKERS = 32       # threads in the shared executor used by multithr_iterate
+
+# API base urls: pointed elsewhere (e.g. a local stand-in) by the benchmarks
+OPENALEX_API = 'https://api.openalex.org'
+NAMSOR_API = 'https://v2.namsor.com/NamSorAPIv2/api2/json'
+
+# requests per second allowed by each API: OpenAlex polite pool and Namsor
+RATE_LIMITS = {'api.openalex.org': 10, 'v2.namsor.com': 5}
+DEFAULT_RATE_LIMIT = 5
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.5      # seconds, doubled on each retry
+MAX_BACKOFF = 60        # seconds
+POOL_SIZE = 32          # connections kept open per host
+TIMEOUT = 60            # seconds
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+class TokenBucket():
+    """ Thread-safe token bucket limiting requests to `rate` per second, with bursts of up to `capacity`.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity else rate
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.not_before = 0 # no requests until then (see pause)
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """ Reserves a token and returns the seconds to wait before using it. 
+            Tokens are reserved under the lock, so waiting callers are served in order.
+            During a pause no tokens are added, and reserved tokens are spaced out from its end.
+        """
+        with self.lock:
+            now = time.monotonic()
+            refill_from = max(self.last, self.not_before)
+            if now > refill_from:
+                self.tokens = min(self.capacity, self.tokens + (now - refill_from) * self.rate)
+            self.last = max(self.last, now)
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            return max(self.not_before - now, 0) + wait
+
+    def acquire(self):
+        """ Blocks until a request may be sent. 
+        """
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        """ Waits without blocking the event loop until a request may be sent. 
+        """
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds):
+        """ Holds back all callers for `seconds`, e.g. when the server asks us to slow down. 
+            Pauses overlap rather than add up: several at once hold callers back until the latest one ends.
+        """
+        with self.lock:
+            self.not_before = max(self.not_before, time.monotonic() + seconds)
+            self.tokens = min(self.tokens, 0) # no burst once the pause ends
+
+_sessions, _limiters = {}, {}
+_clients_lock = threading.Lock()
+
+def limiter(url):
+    """ Given a request url, returns the TokenBucket shared by all requests to its host.
+    """
+    host = urlparse(url).netloc
+    with _clients_lock:
+        if host not in _limiters:
+            _limiters[host] = TokenBucket(RATE_LIMITS.get(host, DEFAULT_RATE_LIMIT))
+        return _limiters[host]
+
+def client(url):
+    """ Given a request url, returns the pooled Session and TokenBucket shared by all requests to its host.
+    """
+    host = urlparse(url).netloc
+    with _clients_lock:
+        if host not in _sessions:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[host] = session
+    return _sessions[host], limiter(url)
+
+def retry_delay(response, attempt):
+    """ Returns seconds to wait before retrying: the server's Retry-After if given,
+        else exponential backoff with jitter.
+    """
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if retry_after:
+        try:
+            return min(MAX_BACKOFF, max(0, float(retry_after)))
+        except ValueError: # HTTP-date
+            try:
+                retry_time = parsedate_to_datetime(retry_after)
+                return min(MAX_BACKOFF, max(0, retry_time.timestamp() - time.time()))
+            except (TypeError, ValueError):
+                pass
+    backoff = min(MAX_BACKOFF, BACKOFF_BASE * 2 ** attempt)
+    return random.uniform(backoff / 2, backoff)
+
+def send(method, url, **kwargs):
+    """ Sends a request through the host's pooled Session under its rate limit, 
+        retrying on 429 Client Error, 5xx Server Errors and connection errors.
+        Returns the Response, or raises requests.exceptions.RequestException.
+    """
+    session, limiter = client(url)
+    host = urlparse(url).netloc
+    for attempt in range(MAX_RETRIES + 1):
+        limiter.acquire()
+        try:
+            response = session.request(method, url, timeout=TIMEOUT, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            metrics.count_request(host, retried=attempt < MAX_RETRIES)
+            if attempt == MAX_RETRIES: raise
+            time.sleep(retry_delay(None, attempt))
+            continue
+        retried = response.status_code in RETRY_STATUSES and attempt < MAX_RETRIES
+        metrics.count_request(host, response.status_code, len(response.content), retried)
+        if retried:
+            delay = retry_delay(response, attempt)
+            if response.status_code == 429: # Handle rate limiter
+                limiter.pause(delay)
+            time.sleep(delay)
+            continue
+        response.raise_for_status()  # Raise an exception for other 4xx or 5xx status codes
+        return response
+
+def redact(error):
+    """ Given an error, returns its message with any API key in the urls it quotes masked.
+    """
+    return re.sub(r'(api_key=)[^&\s]+', r'\1***', str(error))
 
 def api_get(url):
     """ Dispatches GET requests and retries after 429 Client Error.
@@ -13,19 +165,10 @@ def api_get(url):
         Returns results
     """
     try:
-        response = requests.get(url)
-        if response.status_code == 429: # Handle rate limiter
-            #retry_after = response.headers.get('Retry-After')
-            #if retry_after:
-            #    time_diff = retry_after - current_time
-            #   time.sleep(int(time_diff))
-            #else:
-            time.sleep(0.5)  
-            response = requests.get(url)
-        response.raise_for_status()  # Raise an exception for other 4xx or 5xx status codes
+        response = send('GET', url)
         results = response.json()
     except requests.exceptions.RequestException as e:
-        print("Error occurred:", e)
+        print("Error occurred:", redact(e))
         return None
     except ValueError as e:
         print("Error decoding JSON:", e)
@@ -40,17 +183,121 @@ def api_post(url, payload, headers):
             headers: Dictionary of HTTP Headers to send with the Request
     """
     try:
-        response = requests.post(url, json=payload, headers=headers)
-        response.raise_for_status()  # Raise an exception for 4xx or 5xx status codes
+        response = send('POST', url, json=payload, headers=headers)
         results = response.json()
     except requests.exceptions.RequestException as e:
-        print("Error occurred:", e)
+        print("Error occurred:", redact(e))
         return 
     except ValueError as e:
         print("Error decoding JSON:", e)
         return 
     return results 
 
+async def send_async(session, method, url, **kwargs):
+    """ Asynchronous counterpart of send: sends a request through an aiohttp ClientSession
+        under the host's rate limit, with the same retries. 
+        Returns the decoded JSON, or raises aiohttp.ClientError.
+    """
+    host_limiter = limiter(url)
+    host = urlparse(url).netloc
+    timeout = aiohttp.ClientTimeout(total=TIMEOUT)
+    for attempt in range(MAX_RETRIES + 1):
+        await host_limiter.acquire_async()
+        try:
+            async with session.request(method, url, timeout=timeout, **kwargs) as response:
+                body = await response.read()
+                retried = response.status in RETRY_STATUSES and attempt < MAX_RETRIES
+                metrics.count_request(host, response.status, len(body), retried)
+                if retried:
+                    delay = retry_delay(response, attempt)
+                    if response.status == 429: # Handle rate limiter
+                        host_limiter.pause(delay)
+                else:
+                    response.raise_for_status()  # Raise an exception for other 4xx or 5xx status codes
+                    return await response.json(content_type=None)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            metrics.count_request(host, retried=attempt < MAX_RETRIES)
+            if attempt == MAX_RETRIES: raise
+            delay = retry_delay(None, attempt)
+        await asyncio.sleep(delay)
+
+async def api_get_async(session, url):
+    """ Asynchronous api_get, sharing the given aiohttp ClientSession.
+        Args: 
+            session: aiohttp.ClientSession
+            url: str - API request url
+        Returns results
+    """
+    try:
+        return await send_async(session, 'GET', url)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print("Error occurred:", redact(e))
+        return None
+    except ValueError as e:
+        print("Error decoding JSON:", e)
+        return None
+
+async def api_post_async(session, url, payload, headers):
+    """ Asynchronous api_post, sharing the given aiohttp ClientSession.
+        Args: 
+            session: aiohttp.ClientSession
+            url: str - API Request url
+            payload: json - payload to send in the body of the Request
+            headers: Dictionary of HTTP Headers to send with the Request
+    """
+    try:
+        return await send_async(session, 'POST', url, json=payload, headers=headers)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print("Error occurred:", redact(e))
+        return 
+    except ValueError as e:
+        print("Error decoding JSON:", e)
+        return 
+
+def batch_iterate(all_IDs, batch_processing, async_batch_processing, 
+                  batch_size=50, max_workers=15, tuples=False):
+    """ Runs batches on the engine selected by ENGINE (--engine): 
+        batch_processing on threads with multithr_iterate, 
+        or async_batch_processing on the event loop with async_iterate.
+    """
+    if ENGINE == 'async':
+        return async_iterate(all_IDs, async_batch_processing, batch_size=batch_size, tuples=tuples)
+    return multithr_iterate(all_IDs, batch_processing, batch_size=batch_size, 
+                            max_workers=max_workers, tuples=tuples)
+
+def async_iterate(all_IDs, batch_processing, batch_size=50, max_concurrency=ASYNC_CONCURRENCY, tuples=False):
+    """ Given a list of inputs to iterate through and coroutine function to handle a batch of them,
+        returns a list of the results, with the same contract as multithr_iterate.
+        All batches are scheduled at once on one event loop; at most `max_concurrency` run at a time.
+        Args:
+            all_IDs: list of all IDs (can be a list of tuples as well)
+            batch_processing: async function (session, id_batch, i) to apply to each batch
+            batch_size: int (default 50) for number of IDs given to each request
+            max_concurrency: int for number of batches in flight at once
+            tuples: True if result of batch processing should be a tuple
+        Returns:
+            list of results - inner components will be tuples if tuples=True
+    """
+    if aiohttp is None:
+        raise ImportError("The async engine requires aiohttp: conda install aiohttp")
+    id_batches = [all_IDs[i:i + batch_size] for i in range(0, len(all_IDs), batch_size)]
+
+    async def run_all():
+        semaphore = asyncio.Semaphore(max_concurrency)
+        connector = aiohttp.TCPConnector(limit=max_concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            async def run(id_batch, i):
+                async with semaphore:
+                    return await batch_processing(session, id_batch, i)
+            return await asyncio.gather(*[run(id_batch, i) for i, id_batch in enumerate(id_batches)])
+
+    results = list(asyncio.run(run_all()))
+    results.sort(key=lambda x: x[-1])
+    results = [result[:-1] for result in results] # drop indices
+    if tuples:
+        return results
+    return list(itertools.chain.from_iterable(result[0] for result in results))
+
 def multithr_iterate(all_IDs, batch_processing, batch_size=50, max_workers=15, tuples=False):
     """ Given a list of inputs to iterate through and function to handle a batch of them,
         returns a list of the results.
@@ -58,29 +305,113 @@ def multithr_iterate(all_IDs, batch_processing, batch_size=50, max_workers=15, t
             all_IDs: list of all IDs (can be a list of tuples as well)
             batch_processing: function to apply to each batch
             batch_size: int (default 50) for number of IDs given to each thread
-            max_workers: int (default 15) for number of threads/workers
+            max_workers: int (default 15) for number of batches in flight at once
             tuples: True if result of batch processing should be a tuple
         Returns:
-            list of results - inner components will be tuples if tuples=True
+            list of results in batch order - tuples if tuples=True, 
+            else the batches' result lists concatenated
+    """
+    results = sorted(multithr_stream(all_IDs, batch_processing, batch_size, max_workers), 
+                     key=lambda pair: pair[0])  # thread safety
+    results = [result for _, result in results]
+    if tuples:
+        return results
+    return list(itertools.chain.from_iterable(result[0] for result in results))
+
+def multithr_stream(all_IDs, batch_processing, batch_size=50, max_workers=15):
+    """ Streaming variant of multithr_iterate: yields each batch's result as soon as it completes,
+        while later batches are still running. Batches run on the shared executor, 
+        with at most `max_workers` of them submitted at once.
+        Args:
+            all_IDs: list of all IDs (can be a list of tuples as well)
+            batch_processing: function (id_batch, i) -> (*results, i) to apply to each batch
+            batch_size: int (default 50) for number of IDs given to each thread
+            max_workers: int (default 15) for number of batches in flight at once
+        Yields:
+            (i, results) - batch index and the batch's results without the index, in completion order
     """
-    all_results = []
     id_batches = [all_IDs[i:i + batch_size] for i in range(0, len(all_IDs), batch_size)]
-    id_batch_pools = [id_batches[i:i + max_workers] for i in range(0, len(id_batches), max_workers)]
-
-    for pool in tqdm(id_batch_pools):
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            batch_futures = [executor.submit(batch_processing, id_batch, i) for i, id_batch in enumerate(pool)]
-            wait(batch_futures)
-            
-            results = [task.result() for task in batch_futures]
-            results.sort(key=lambda x: x[-1])  # thread safety
-            results = [result[:-1] for result in results] # drop indices
-
-            if tuples:
-                for tuple in results:
-                    all_results.append(tuple)
-            else:
-                pooled_results = list(itertools.chain.from_iterable(results))
-                all_results.append(pooled_results) # list of lists
-        
-    return all_results
\ No newline at end of file
+    unsubmitted = iter(enumerate(id_batches))
+    executor = shared_executor()
+    in_flight = set()
+
+    def submit():
+        for i, id_batch in unsubmitted:
+            in_flight.add(executor.submit(batch_processing, id_batch, i))
+            if len(in_flight) >= max_workers: 
+                return
+
+    with tqdm(total=len(id_batches)) as progress:
+        submit()
+        try:
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    in_flight.remove(future)
+                    result = future.result()
+                    progress.update(1)
+                    yield result[-1], result[:-1]
+                submit()
+        finally:
+            for future in in_flight: # caller stopped early
+                future.cancel()
+
+_executor = None
+
+def shared_executor():
+    """ Returns the process-wide ThreadPoolExecutor, created on first use, 
+        so worker threads are started once and reused by every batch. 
+    """
+    global _executor
+    with _clients_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS)
+        return _executor
+
+def prefetch_chain(iterables, depths=None):
+    """ Given several iterables whose items are slow to produce, produces all of them at once, 
+        each on its own background thread, while the caller consumes the items in order: 
+        every item of the first iterable, then of the second, and so on.
+        Args:
+            iterables: list of iterables of items to produce in the background
+            depths: optional list of the maximum number of items of each iterable produced ahead of 
+                    the consumer (None for no limit); default 2 each
+        Yields:
+            items of each iterable, in order. Exceptions raised by a producer are re-raised when reached.
+    """
+    done = object()
+    depths = depths or [2] * len(iterables)
+    queues = [queue.Queue(maxsize=max(depth, 1) if depth is not None else 0) for depth in depths]
+    stopped = threading.Event()
+
+    def put(items, item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce(iterable, items):
+        try:
+            for item in iterable:
+                if not put(items, (item, None)): 
+                    return
+        except Exception as e:
+            put(items, (done, e))
+            return
+        put(items, (done, None))
+
+    for iterable, items in zip(iterables, queues):
+        threading.Thread(target=produce, args=(iterable, items), daemon=True).start()
+    try:
+        for items in queues:
+            while True:
+                item, error = items.get()
+                if item is done:
+                    if error: raise error
+                    break
+                yield item
+    finally:
+        stopped.set() # consumer finished or stopped early: release the producers
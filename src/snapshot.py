@@ -0,0 +1,54 @@
+import os
+import json
+from datetime import datetime, timezone
+import pandas as pd
+
+SNAPSHOT_VERSION = 1
+WORKS_TABLE = 'works.parquet'
+METADATA_FILE = 'metadata.json'
+
+def save_snapshot(data, dst):
+    """ Given a Data object, writes its works to `dst` as a versioned snapshot: 
+        a Parquet table of works (list-typed columns kept as lists) and a JSON metadata sidecar.
+        Files are written under temporary names and then moved into place, 
+        so an interrupted save leaves the previous snapshot intact.
+    """
+    os.makedirs(dst, exist_ok=True)
+    metadata = {'version' : SNAPSHOT_VERSION,
+                'saved_at' : datetime.now(timezone.utc).isoformat(),
+                'journal_name' : data.analysis.journal_name,
+                'source_id' : data.source_id,
+                'num_works' : data.num_works,
+                'sample_size' : data.analysis.sample_size,
+                'start_year' : data.analysis.start_year,
+                'end_year' : data.analysis.end_year,
+                'columns' : list(data.works.columns)}
+
+    data.decode_abstracts() # abstracts still held as inverted indexes are saved as text
+    works_path = os.path.join(dst, WORKS_TABLE)
+    data.works.to_parquet(works_path + '.tmp', index=False)
+    os.replace(works_path + '.tmp', works_path)
+
+    metadata_path = os.path.join(dst, METADATA_FILE)
+    with open(metadata_path + '.tmp', 'w') as f:
+        json.dump(metadata, f, indent=4)
+    os.replace(metadata_path + '.tmp', metadata_path)
+
+def load_metadata(src):
+    """ Given the path to a snapshot, returns its metadata as a dict.
+    """
+    with open(os.path.join(src, METADATA_FILE), 'r') as f:
+        metadata = json.load(f)
+    if metadata['version'] != SNAPSHOT_VERSION:
+        raise Exception("Saved data at " + src + " has snapshot version " + str(metadata['version']) + 
+                        ", expected " + str(SNAPSHOT_VERSION) + ". Rerun without restoring saved data.")
+    return metadata
+
+def load_works(src, columns=None):
+    """ Given the path to a snapshot, returns its works DataFrame,
+        memory-mapped and limited to `columns` if given.
+    """
+    return pd.read_parquet(os.path.join(src, WORKS_TABLE), columns=columns, memory_map=True)
+
+def exists(src):
+    return os.path.exists(os.path.join(src, METADATA_FILE))
@@ -0,0 +1,91 @@
+import numpy as np
+import pandas as pd
+
+def aggregate(works, bucket_sizes=(5,)):
+    """ Given a works DataFrame, computes all summary statistics from one explode of each list column.
+        Args:
+            works: DataFrame of works (see Data.works)
+            bucket_sizes: year bucket sizes to count genders by, e.g. (5, 10)
+        Returns:
+            dict of 
+                'works': int number of works
+                'authorships': int number of authorships
+                'works_by_year': DataFrame of year, works - works per publication year
+                'institutions': DataFrame of institution, publications - works per institution, most first
+                'gender_by_year': dict of bucket size -> DataFrame of year, male, female author counts 
+                                  (if works have genders)
+                'fraction_female': float fraction of authors predicted female (if works have genders)
+                'countries': DataFrame of country, works, ... - with a countries column, works per 
+                             author country (see country_counts); else located works per institution country 
+                             (if works have geodata)
+                'countries_by_year': DataFrame of year, country, works (if works have a countries column)
+                'fraction_international': float fraction of works with authors in more than one country 
+                                          (if works have a countries column)
+    """
+    aggregates = {'works' : len(works),
+                  'authorships' : int(works['authors'].map(len).sum()),
+                  'works_by_year' : works_by_year(works['year']),
+                  'institutions' : institution_counts(works)}
+    if 'genders' in works:
+        authors = author_rows(works)
+        aggregates['gender_by_year'] = {size : gender_by_year(authors, size) for size in bucket_sizes}
+        aggregates['fraction_female'] = (authors['gender'] == 'female').mean() if len(authors) else np.nan
+    if 'countries' in works:
+        aggregates['countries'] = country_counts(works)
+        aggregates['countries_by_year'] = countries_by_year(works)
+        aggregates['fraction_international'] = (works['countries'].map(set).map(len) > 1).mean()
+    elif 'country' in works:
+        countries = works['country'].dropna().value_counts()
+        aggregates['countries'] = countries.rename_axis('country').reset_index(name='works')
+    return aggregates
+
+def author_rows(works):
+    """ Given works with a genders column, returns one row per author: the work's year and the author's gender.
+    """
+    genders = works['genders'].explode().dropna()
+    return pd.DataFrame({'year' : works['year'].reindex(genders.index).to_numpy(), 
+                         'gender' : genders.to_numpy()})
+
+def gender_by_year(authors, bucket_size):
+    """ Given author rows, returns counts of male and female authors per bucket of `bucket_size` years.
+    """
+    authors = authors[authors['year'].notna()]
+    buckets = (authors['year'].astype(int).to_numpy() // bucket_size) * bucket_size
+    counts = pd.crosstab(buckets, authors['gender'].to_numpy())
+    counts = counts.reindex(columns=['male', 'female'], fill_value=0).sort_index()
+    return counts.rename_axis('year').reset_index().rename_axis(None, axis=1)
+
+def works_by_year(years):
+    """ Given the publication year of each work, returns the number of works per year, in order of year.
+    """
+    counts = years.dropna().astype(int).value_counts().sort_index()
+    return counts.rename_axis('year').reset_index(name='works')
+
+def institution_counts(works):
+    """ Returns the number of works of each institution (each counted once per work), most first.
+    """
+    institutions = works['institutions'].map(set).explode().dropna().value_counts()
+    return institutions.rename_axis('institution').reset_index(name='publications')
+
+def country_counts(works):
+    """ Given works with a countries column, returns per country (ISO code): works with an author there 
+        (each counted once), authorships there, fractional works (each work split evenly among 
+        its authorships' countries) and share of works with any country, most works first.
+    """
+    countries = works['countries'].explode().dropna()
+    weights = 1 / works['countries'].map(len).reindex(countries.index)
+    pairs = pd.DataFrame({'country' : countries.to_numpy(), 'work' : countries.index.to_numpy(), 
+                          'weight' : weights.to_numpy()})
+    counts = pairs.groupby('country').agg(works=('work', 'nunique'), authorships=('work', 'size'), 
+                                          fractional_works=('weight', 'sum'))
+    counts['share'] = counts['works'] / max(1, works['countries'].map(len).gt(0).sum())
+    return counts.sort_values('works', ascending=False, kind='stable').reset_index()
+
+def countries_by_year(works):
+    """ Given works with a countries column, returns the number of works with an author in each country per year.
+    """
+    countries = works['countries'].map(set).explode().dropna()
+    years = works['year'].reindex(countries.index)
+    dated = years.notna().to_numpy()
+    pairs = pd.DataFrame({'year' : years[dated].astype(int).to_numpy(), 'country' : countries[dated].to_numpy()})
+    return pairs.groupby(['year', 'country']).size().reset_index(name='works')
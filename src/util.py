@@ -1,9 +1,5 @@
-from operator import invert
-import pickle
-import requests
+import os
 import json
-import time
-#import datetime
 
 VERBOSE = False
 def info(text):
@@ -25,12 +21,25 @@ def unique(duplicates):
     uniques_list = list(uniques)
     return uniques_list
 
+def ordered_unique(duplicates):
+    """ Given a list, return that list without duplicates, in order of first appearance
+    """
+    return list(dict.fromkeys(duplicates))
+
 def foldl(base, fn, lst):
     result = base.copy()
     for item in lst:
         result = fn(result, item)
     return result
 
+def suffix_path(path, suffix):
+    """ Given a file or directory path, returns it with '-suffix' before the extension 
+        (data.csv -> data-suffix.csv). Empty paths are returned as is.
+    """
+    if not path: return path
+    root, extension = os.path.splitext(path.rstrip('/'))
+    return root + '-' + suffix + extension
+
 def load_config(file_path):
     """ Given a path to a config file, returns as JSON object. 
     """
@@ -54,21 +63,6 @@ def valid_title(title):
             title != "Volume Information" and\
             "the following abbreviations are used in this issue" not in title.lower()
 
-def pickle_data(data, dst="../data/pickled_data"):
-    """ Given a data object, 
-        writes pickled files to `dst`. 
-    """
-    pickled_data = open(dst, 'wb')
-    pickle.dump(data, pickled_data)
-
-def unpickle_data(src):
-    """ Given the filepath to a pickled object,
-        returns the unpickled Data object.
-    """
-    pickled_data = open(src, 'rb')
-    data = pickle.load(pickled_data)
-    return data
-
 def deNone(name):
     if not name: return 'NA' 
     else: return name
@@ -125,23 +119,32 @@ def add_to_inverted_index(key, index, inverted_index):
     else:
         inverted_index[key].append(index)
 
-def decode_inverted(inverted_index, return_tuples=False):
+def decode_inverted(inverted_index):
     """ Converts an inverted index to list of words in the correct order
             Args:
                 inverted_index: dict of word : [indices] representing an abstract
-                return_tuples: default False, when True, returns list of tuples not list of strings
             Returns:
-                list[str] - list of words ordered by index, or list[(str, int)] sorted by index
+                list[str] - list of words ordered by index
     """
     if not inverted_index: return 'NA'
 
-    word_index = [] 
+    # scatter each word straight into its position: linear time, no sort
+    length = 1 + max(max(indices) for indices in inverted_index.values() if indices)
+    words = [None] * length
     for word, indices in inverted_index.items():
         for index in indices:
-            word_index.append([word, index])
+            words[index] = word
+    return [word for word in words if word is not None] # skip any gaps in the positions
 
-    sorted_tuples = sorted(word_index, key = lambda x : x[1])
-    if return_tuples: 
-        return sorted_tuples
-    words = [word[0] for word in sorted_tuples]
-    return words
\ No newline at end of file
+def decode_abstract(inverted_index):
+    """ Given an abstract as an inverted index (or text already decoded), returns its text, 'NA' if missing.
+    """
+    if isinstance(inverted_index, str): return inverted_index
+    if not isinstance(inverted_index, dict) or not any(inverted_index.values()): return 'NA' # None, or NaN from a merge
+    return ' '.join(decode_inverted(inverted_index))
+
+def decode_abstracts(inverted_indexes):
+    """ Given a page or column of abstracts as inverted indexes, returns a list of their texts,
+        decoding each in turn (see decode_abstract); abstracts already decoded are passed through.
+    """
+    return [decode_abstract(inverted_index) for inverted_index in inverted_indexes]
@@ -0,0 +1,64 @@
+import os
+
+class CsvStreamWriter():
+    """ Writes a CSV one DataFrame chunk at a time: the header is written with the first chunk, 
+        and each chunk is flushed to disk as soon as it is written, so only one chunk is held in memory.
+        With atomic=True, rows are written to a temporary file that replaces `path` on close;
+        otherwise they go straight to `path`, which then holds usable partial output if the run stops.
+    """
+    def __init__(self, path, atomic=False):
+        self.path = path
+        self.atomic = atomic
+        self.rows = 0
+        self.file = open(self.write_path(), 'w', newline='')
+
+    def write_path(self):
+        return self.path + '.tmp' if self.atomic else self.path
+
+    def write(self, df):
+        df = df.set_axis(range(self.rows, self.rows + len(df))) # row numbers continue across chunks
+        df.to_csv(self.file, header=(self.rows == 0))
+        self.file.flush()
+        self.rows += len(df)
+
+    def close(self):
+        self.file.close()
+        if self.atomic:
+            os.replace(self.write_path(), self.path)
+
+class ParquetStreamWriter():
+    """ Writes a Parquet file one DataFrame chunk at a time, each chunk as a row group, 
+        with the schema of the first chunk. Requires pyarrow. See CsvStreamWriter for `atomic`.
+    """
+    def __init__(self, path, atomic=False):
+        self.path = path
+        self.atomic = atomic
+        self.writer = None
+
+    def write_path(self):
+        return self.path + '.tmp' if self.atomic else self.path
+
+    def write(self, df):
+        if not len(df): return # an empty chunk (e.g. a page of only issue components) has no types to go by
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        if self.writer is None:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            self.writer = pq.ParquetWriter(self.write_path(), table.schema)
+        else:
+            table = pa.Table.from_pandas(df, schema=self.writer.schema, preserve_index=False)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is None: return
+        self.writer.close()
+        if self.atomic:
+            os.replace(self.write_path(), self.path)
+
+def open_writers(csv_path, parquet_path=None, atomic=False):
+    """ Returns stream writers for the CSV output and, if configured, the Parquet output.
+    """
+    writers = [CsvStreamWriter(csv_path, atomic)]
+    if parquet_path:
+        writers.append(ParquetStreamWriter(parquet_path, atomic))
+    return writers